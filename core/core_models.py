@@ -1,12 +1,13 @@
 ''' core_models is a module which holds classes realted to core features. Such as a class that holds test statuses,
     or the test definition. These classes are usually shared across core modules and re-used often, sometimes by other
     modules not related to core.  '''
+import sys
 import random
 import string
 import itertools
 import platform
 from datetime               import datetime
-from typing                 import Dict
+from typing                 import Dict, List
 from utilities.json_helper  import LoadJson
 
 
@@ -70,6 +71,10 @@ class TraverseConfig:
         2nd parameter is the main directory(root) that the framework is currently in.
     '''
     def __init__(self, exec_config: Dict, test_run: Dict, root_dir: str):
+        # Keep the loaded json as is, the coordinator sends it to agents which build their own traverse config from it
+        self.exec_config = exec_config
+        self.test_run = test_run
+
         try:
             # Deal with Tests folder value
             if exec_config['testsFolder'] == '':
@@ -80,6 +85,15 @@ class TraverseConfig:
             else:
                 self.tests_folder = exec_config['testsFolder']
 
+            # Deal with History folder value, older executor configs may not have it
+            if exec_config.get('historyFolder', '') == '':
+                if platform.system() == 'Windows':
+                    self.history_folder = f'{root_dir}\\history'
+                else:
+                    self.history_folder = f'{root_dir}/history'
+            else:
+                self.history_folder = exec_config['historyFolder']
+
             # Rest of Executor Config
             self.parallel_tests = exec_config['parallelTests']
             self.test_retries = exec_config['testRetries']
@@ -87,12 +101,52 @@ class TraverseConfig:
             self.test_result_updates = exec_config['testResultUpdates']
             self.live_environment_name = exec_config['liveEnvironmentName']
             self.environment = exec_config['environmentName']
+            self.async_concurrency = exec_config.get('asyncConcurrency', 100)
+            self.schedule_by_duration = exec_config.get('scheduleByDuration', True)
+            self.lazy_batch_size = exec_config.get('lazyBatchSize', 200) # Tests taken out of a lazy cartesian product at a time
+            self.test_timeout = exec_config.get('testTimeout', 0)
+            self.discovery_index = exec_config.get('discoveryIndex', True) # Remember the test cases of unchanged suites between runs
+            self.test_discovery = exec_config.get('testDiscovery', 'ast').lower() # Parse suite files (ast) or import them (import)
+
+            # Adaptive workers grow and shrink the worker pool between the min and max going by the load of the machine
+            adaptive_workers = exec_config.get('adaptiveWorkers', {})
+            self.adaptive_workers = adaptive_workers.get('enabled', False)
+            self.min_workers = adaptive_workers.get('minWorkers', 1)
+            self.max_workers = adaptive_workers.get('maxWorkers', self.parallel_tests +1)
+            self.max_cpu_percent = adaptive_workers.get('maxCpuPercent', 85)
+            self.max_memory_percent = adaptive_workers.get('maxMemoryPercent', 85)
+            self.max_load_per_cpu = adaptive_workers.get('maxLoadPerCpu', 1.5)
+            self.sizing_interval = adaptive_workers.get('sampleInterval', 10)
+
+            # Workers are replaced after executing this many tests or once they use this much memory, 0 never replaces them
+            worker_recycling = exec_config.get('workerRecycling', {})
+            self.worker_max_tests = worker_recycling.get('maxTests', 0)
+            self.worker_max_memory_mb = worker_recycling.get('maxMemoryMb', 0)
+
+            # Failure screenshots, the quality is for jpeg and webp, the compression for png. No png compression keeps the driver's png.
+            self.screenshot_format = exec_config.get('screenshotFormat', 'png').lower()
+            self.screenshot_quality = exec_config.get('screenshotQuality', 80)
+            self.screenshot_compression = exec_config.get('screenshotCompression')
+
+            # How many tests of a capability or resource tag may run at the same time, on top of parallel tests. Not limited if left out.
+            concurrency_limits = exec_config.get('concurrencyLimits', {})
+            self.capability_limits: Dict[str, int] = concurrency_limits.get('capabilities', {})
+            self.resource_limits: Dict[str, int] = concurrency_limits.get('resourceTags', {})
+
+            # Tests with a flakiness score of at least the threshold run in the quarantine lane, with their own retries
+            quarantine = exec_config.get('quarantine', {})
+            self.quarantine_enabled = quarantine.get('enabled', False)
+            self.flakiness_threshold = quarantine.get('flakinessThreshold', 0.2)
+            self.flakiness_min_runs = quarantine.get('minRuns', 5)
+            self.quarantine_retries = quarantine.get('retries', 2)
+            self.quarantine_workers = quarantine.get('workers', 1) # Workers kept for the quarantine lane while other tests are waiting
 
             # Test Run Config
             self.test_run_name = test_run['testRunName']
             self.platform = test_run['platform']
             self.capabilities = test_run['capabilities']
             self.tests = test_run['tests']
+            self.tag_expression = test_run.get('tagExpression') # Only the tests matching it are executed, see core.test_selection
 
             # Load Logger and Reporter config
             logger_config_name = test_run['loggerConfig']
@@ -130,11 +184,42 @@ class TraverseConfig:
             # Validation on settings
             if self.parallel_tests < 0:
                 raise Exception('Parallel tests set to less than 0!')
+            if self.lazy_batch_size < 1:
+                raise Exception('Lazy batch size set to less than 1!')
+            if self.async_concurrency < 1:
+                raise Exception('Async concurrency set to less than 1!')
+            if self.adaptive_workers is True and (self.min_workers < 1 or self.max_workers < self.min_workers):
+                raise Exception('Adaptive workers need at least 1 min worker and max workers of at least min workers!')
+            if self.test_discovery not in ('ast', 'import'):
+                raise Exception('Test discovery must be ast or import!')
+            if self.screenshot_format not in ('png', 'jpeg', 'webp'):
+                raise Exception('Screenshot format must be png, jpeg or webp!')
+            if any(limit < 1 for limit in list(self.capability_limits.values()) + list(self.resource_limits.values())):
+                raise Exception('Concurrency limits set to less than 1!')
+            if self.quarantine_enabled is True and not 0 < self.flakiness_threshold <= 1:
+                raise Exception('Quarantine flakiness threshold must be above 0 and at most 1!')
+            if self.quarantine_workers < 0:
+                raise Exception('Quarantine workers set to less than 0!')
 
         except KeyError as error:
             raise Exception(f'Could not load key {error.args[0]} in Traverse Config') from error
 
 
+    @staticmethod
+    def load(config_name: str, test_run_name: str, root_dir: str):
+        ''' Loads the executor config and test run with the names passed in from the root directory and returns the traverse config. '''
+        if platform.system() == 'Windows':
+            exec_config_path = f'{root_dir}\\config\\executor\\{config_name}.json'
+            test_run_path = f'{root_dir}\\test_runs\\{test_run_name}.json'
+        else:
+            exec_config_path = f'{root_dir}/config/executor/{config_name}.json'
+            test_run_path = f'{root_dir}/test_runs/{test_run_name}.json'
+
+        exec_config = LoadJson.using_filepath(exec_config_path)
+        test_run = LoadJson.using_filepath(test_run_path)
+        return TraverseConfig(exec_config, test_run, root_dir)
+
+
 class TestStatus:
     ''' A holding class for all available test statuses. '''
     UNTESTED = 'Untested'
@@ -145,27 +230,273 @@ class TestStatus:
     IN_PROGRESS = 'InProgress'
 
 
+class SuiteHooks:
+    '''
+        The names of the optional suite level hooks a Tests class can define, as static or class methods. setup_suite(traverse_config)
+        runs once per worker before the first test of the suite, what it returns is available to every test as self.suite_fixture.
+        teardown_suite(traverse_config, suite_fixture) runs when the worker shuts down. These are not picked up as tests.
+    '''
+    SETUP = 'setup_suite'
+    TEARDOWN = 'teardown_suite'
+
+
+def _suite_value(name):
+    '''
+        Returns a property which reads the value passed in from the suite record of a test definition. Setting it gives the test its
+        own copy of the suite record, the record it shared with the other tests of its suite is left as it was.
+    '''
+    def get_value(test_def: 'TestDefinition'):
+        return getattr(test_def.suite_record, name)
+
+    def set_value(test_def: 'TestDefinition', value):
+        suite_values = {suite_name: getattr(test_def.suite_record, suite_name) for suite_name in SuiteRecord.SUITE_VALUES}
+        suite_values[name] = value
+        test_def.suite_record = SuiteRecord(**suite_values)
+
+    return property(get_value, set_value)
+
+
 class TestDefinition:
-    ''' A class used to track, and keep context of test information for preparing, setup, execution and reporting. '''
+    '''
+        A class used to track, and keep context of test information for preparing, setup, execution and reporting. A test run can
+        hold tens of thousands of these, so they are slotted and the values every test of a suite shares (test pack, test suite,
+        production safe, screenshot dir and tests json) are kept once, in the suite record the tests point to. Those values are
+        read and set like any other attribute.
+    '''
+    __slots__ = ('test_id', 'suite_record', 'test_name', 'platform', 'capability', 'test_config_title', 'test_config_value',
+                 'test_status', 'test_start_time', 'test_end_time', 'test_attempts', 'comments', 'inputs_hash', 'depends_on',
+                 'memory_before', 'memory_after', 'quarantined')
     id_itr = itertools.count()
-    def __init__(self):
+
+    test_pack = _suite_value('test_pack')
+    test_suite = _suite_value('test_suite')
+    production_safe = _suite_value('production_safe')
+    screenshot_dir = _suite_value('screenshot_dir')
+    tests_json = _suite_value('tests_json')
+
+    def __init__(self, suite_record: 'SuiteRecord' = None):
         self.test_id = next(self.id_itr)
-        self.test_pack = None
-        self.test_suite = None
+        self.suite_record = suite_record if suite_record is not None else SuiteRecord(None, None, None, False, None)
         self.test_name = None
         self.platform = None
         self.capability = None # If -1 is passed in, this will not require a driver
         self.test_config_title = None
         self.test_config_value = None
-        self.production_safe = False
 
         self.test_status = TestStatus.UNTESTED
         self.test_start_time = None
         self.test_end_time = None
+        self.test_attempts = 0
         self.comments = ''
 
-        self.screenshot_dir = None
-        self.tests_json:Dict = None
+        self.inputs_hash = None # Hash of the files the test depends on, set by the profiler
+        self.depends_on: List[int] = [] # Test ids of the tests which must pass before this one runs, set by the profiler
+        self.memory_before = None # Memory (RSS bytes) of the worker right before and after the test, set by the worker
+        self.memory_after = None
+        self.quarantined = False # Set by the executor for known flaky tests, they run in the quarantine lane
+
+    def __getstate__(self):
+        ''' Pickles the test as a plain tuple of its values. Tests of the same suite pickled together share one suite record. '''
+        return tuple(getattr(self, attribute) for attribute in self.__slots__)
+
+    def __setstate__(self, state):
+        ''' Unpickles a test pickled by __getstate__, the names and config values are interned again. '''
+        for attribute, value in zip(self.__slots__, state):
+            setattr(self, attribute, value)
+        self.intern_strings()
+
+    def intern_strings(self):
+        ''' Interns the name, platform, capability and config of the test, so the tests of a test run share one copy of each. '''
+        for attribute in ('test_name', 'platform', 'capability', 'test_config_title', 'test_config_value'):
+            value = getattr(self, attribute)
+            if isinstance(value, str):
+                setattr(self, attribute, sys.intern(value))
+
+    def to_dict(self):
+        ''' Returns the test definition and its result as a json friendly dict, used to save results to disk. The tests json is left out. '''
+        return {
+            'testId': self.test_id,
+            'testPack': self.test_pack,
+            'testSuite': self.test_suite,
+            'testName': self.test_name,
+            'platform': self.platform,
+            'capability': self.capability,
+            'testConfigTitle': self.test_config_title,
+            'testConfigValue': self.test_config_value,
+            'productionSafe': self.production_safe,
+            'testStatus': self.test_status,
+            'testStartTime': self.test_start_time.isoformat() if self.test_start_time else None,
+            'testEndTime': self.test_end_time.isoformat() if self.test_end_time else None,
+            'testAttempts': self.test_attempts,
+            'comments': self.comments,
+            'screenshotDir': self.screenshot_dir,
+            'inputsHash': self.inputs_hash,
+            'memoryBefore': self.memory_before,
+            'memoryAfter': self.memory_after,
+            'quarantined': self.quarantined
+        }
+
+    @staticmethod
+    def from_dict(test_dict: Dict):
+        ''' Builds a test definition out of a dict created by to_dict. '''
+        test_def = TestDefinition(SuiteRecord(test_dict['testPack'], test_dict['testSuite'], {}, test_dict['productionSafe'],
+                                              test_dict['screenshotDir']))
+        test_def.test_id = test_dict['testId']
+        test_def.test_name = test_dict['testName']
+        test_def.platform = test_dict['platform']
+        test_def.capability = test_dict['capability']
+        test_def.test_config_title = test_dict['testConfigTitle']
+        test_def.test_config_value = test_dict['testConfigValue']
+        test_def.test_status = test_dict['testStatus']
+        test_def.test_start_time = datetime.fromisoformat(test_dict['testStartTime']) if test_dict['testStartTime'] else None
+        test_def.test_end_time = datetime.fromisoformat(test_dict['testEndTime']) if test_dict['testEndTime'] else None
+        test_def.test_attempts = test_dict['testAttempts']
+        test_def.comments = test_dict['comments']
+        test_def.inputs_hash = test_dict.get('inputsHash')
+        test_def.memory_before = test_dict.get('memoryBefore')
+        test_def.memory_after = test_dict.get('memoryAfter')
+        test_def.quarantined = test_dict.get('quarantined', False)
+        test_def.intern_strings()
+        return test_def
+
+
+class SuiteRecord:
+    ''' Holds the values every test of a test suite shares, so they are kept (and sent to executor workers) once per suite
+        instead of once per test. '''
+    SUITE_VALUES = ('test_pack', 'test_suite', 'tests_json', 'production_safe', 'screenshot_dir', 'async_tests') # The values passed in to create one
+    __slots__ = SUITE_VALUES + ('test_timeout', 'resource_tags')
+
+    def __init__(self, test_pack, test_suite, tests_json: Dict, production_safe, screenshot_dir, async_tests: List[str] = None):
+        self.test_pack = sys.intern(test_pack) if isinstance(test_pack, str) else test_pack
+        self.test_suite = sys.intern(test_suite) if isinstance(test_suite, str) else test_suite
+        self.tests_json = tests_json
+        self.production_safe = production_safe
+        self.screenshot_dir = screenshot_dir
+        self.async_tests = async_tests # The async def test cases found by discovery, None if discovery did not look at the suite
+        self.test_timeout = tests_json.get('testTimeout') if tests_json else None # Overrides the executor config test timeout
+        self.resource_tags: List[str] = tests_json.get('resourceTags', []) if tests_json else [] # Count towards the concurrency limits
+
+    @staticmethod
+    def key_for(test_pack, test_suite):
+        ''' Returns the key used to look up a suite record for the test pack and test suite passed in. '''
+        return f'{test_pack}/{test_suite}'
+
+    @staticmethod
+    def from_test_definition(test_def: TestDefinition):
+        ''' Returns the suite record of a test definition. '''
+        return test_def.suite_record
+
+    def __getstate__(self):
+        ''' Pickles the suite record as a plain tuple of the values it was created with. '''
+        return tuple(getattr(self, attribute) for attribute in self.SUITE_VALUES)
+
+    def __setstate__(self, state):
+        ''' Unpickles a suite record pickled by __getstate__, the test timeout and resource tags are worked out again. '''
+        SuiteRecord.__init__(self, *state)
+
+    def to_dict(self):
+        ''' Returns the suite record as a json friendly dict. The screenshot dir is left out, it depends on the machine. '''
+        return {'testPack': self.test_pack, 'testSuite': self.test_suite, 'testsJson': self.tests_json, 'productionSafe': self.production_safe,
+                'asyncTests': self.async_tests}
+
+    @staticmethod
+    def from_dict(suite_dict: Dict, trav_con: 'TraverseConfig'):
+        ''' Builds the suite record out of a dict created by to_dict, the screenshot dir is taken from the traverse config passed in. '''
+        if platform.system() == 'Windows':
+            screenshot_dir = f"{trav_con.testrun_result_dir}\\{suite_dict['testPack']}\\{suite_dict['testSuite']}"
+        else:
+            screenshot_dir = f"{trav_con.testrun_result_dir}/{suite_dict['testPack']}/{suite_dict['testSuite']}"
+
+        return SuiteRecord(suite_dict['testPack'], suite_dict['testSuite'], suite_dict['testsJson'], suite_dict['productionSafe'], screenshot_dir,
+                           suite_dict.get('asyncTests'))
+
+
+class TestTask:
+    '''
+        The lean wire format of a test definition, this is what the executor sends to a worker for every test. It only holds the
+        test id, the suite key and the config values, the worker rebuilds the full test definition using the suite records it
+        received once when it started.
+    '''
+    __slots__ = ('test_id', 'suite_key', 'test_name', 'capability', 'test_config_title', 'test_config_value')
+
+    def __init__(self, test_id, suite_key, test_name, capability, test_config_title, test_config_value):
+        self.test_id = test_id
+        self.suite_key = suite_key
+        self.test_name = test_name
+        self.capability = capability
+        self.test_config_title = test_config_title
+        self.test_config_value = test_config_value
+
+    @staticmethod
+    def from_test_definition(test_def: TestDefinition):
+        ''' Creates the task for the test definition passed in. '''
+        return TestTask(test_def.test_id, SuiteRecord.key_for(test_def.test_pack, test_def.test_suite), test_def.test_name,
+                        test_def.capability, test_def.test_config_title, test_def.test_config_value)
+
+    def to_dict(self):
+        ''' Returns the task as a json friendly dict, used to send tasks to agents on other machines. '''
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @staticmethod
+    def from_dict(task_dict: Dict):
+        ''' Builds the task out of a dict created by to_dict. '''
+        return TestTask(**task_dict)
+
+    def to_test_definition(self, suite_record: SuiteRecord, platform_name):
+        ''' Rebuilds the full test definition out of this task, the suite record it belongs to and the platform of the test run. '''
+        test_def = TestDefinition(suite_record)
+        test_def.test_id = self.test_id
+        test_def.test_name = self.test_name
+        test_def.platform = platform_name
+        test_def.capability = self.capability
+        test_def.test_config_title = self.test_config_title
+        test_def.test_config_value = self.test_config_value
+        return test_def
+
+
+class TestResult:
+    ''' The lean wire format a worker sends back to the executor once a test is done. Only the values a test changes are sent. '''
+    __slots__ = ('test_id', 'test_status', 'test_start_time', 'test_end_time', 'comments', 'memory_before', 'memory_after')
+
+    def __init__(self, test_id, test_status, test_start_time, test_end_time, comments, memory_before=None, memory_after=None):
+        self.test_id = test_id
+        self.test_status = test_status
+        self.test_start_time = test_start_time
+        self.test_end_time = test_end_time
+        self.comments = comments
+        self.memory_before = memory_before
+        self.memory_after = memory_after
+
+    @staticmethod
+    def from_test_definition(test_def: TestDefinition):
+        ''' Creates the result out of an executed test definition. '''
+        return TestResult(test_def.test_id, test_def.test_status, test_def.test_start_time, test_def.test_end_time, test_def.comments,
+                          test_def.memory_before, test_def.memory_after)
+
+    def to_dict(self):
+        ''' Returns the result as a json friendly dict, used by agents to send results back to the coordinator. '''
+        result_dict = {attribute: getattr(self, attribute) for attribute in self.__slots__}
+        result_dict['test_start_time'] = self.test_start_time.isoformat() if self.test_start_time else None
+        result_dict['test_end_time'] = self.test_end_time.isoformat() if self.test_end_time else None
+        return result_dict
+
+    @staticmethod
+    def from_dict(result_dict: Dict):
+        ''' Builds the result out of a dict created by to_dict. '''
+        result = TestResult(**result_dict)
+        result.test_start_time = datetime.fromisoformat(result.test_start_time) if result.test_start_time else None
+        result.test_end_time = datetime.fromisoformat(result.test_end_time) if result.test_end_time else None
+        return result
+
+    def apply_to(self, test_def: TestDefinition):
+        ''' Copies the result onto the executor's own test definition and returns it. '''
+        test_def.test_status = self.test_status
+        test_def.test_start_time = self.test_start_time
+        test_def.test_end_time = self.test_end_time
+        test_def.comments = self.comments
+        test_def.memory_before = self.memory_before
+        test_def.memory_after = self.memory_after
+        return test_def
 
 
 class ReportDeliveryType:
@@ -173,3 +504,4 @@ class ReportDeliveryType:
     CMD = 'cmd'
     HTML = 'html'
     EMAIL = 'email'
+    JSON = 'json'
@@ -0,0 +1,211 @@
+''' The daemon keeps traverse running in the background with warm workers, so a test run which is executed often (like production
+    monitoring) does not pay for starting python, importing the drivers and starting a worker pool every time. Test runs are submitted
+    over localhost HTTP and the result of every test is streamed back as soon as it finished. '''
+import json
+import threading
+import http.client
+from http.server            import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing                 import Dict
+
+from tqdm                   import tqdm
+from core.core_models       import TraverseConfig, TestDefinition, TestStatus
+from core.test_profiler     import Profiler
+from core.test_executor     import Executor
+from core.test_reporter     import Reporter, ReporterTasks
+from core.test_worker       import WorkerCache, WorkerPool
+from core.test_distributor  import MessageChannel
+
+
+class DaemonMessageType:
+    ''' A holding class for the types of json lines the daemon streams back for a submitted test run. '''
+    RESULT = 'result'
+    SUMMARY = 'summary'
+    ERROR = 'error'
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    '''
+        Handles the HTTP requests of the daemon. POST /runs with a json body like {"config": "default", "testRun": "smoke"} executes
+        the test run and streams back one json line per finished test, followed by a summary line.
+    '''
+    def do_POST(self):
+        ''' Executes the submitted test run and streams its results back to the client. '''
+        daemon: Daemon = self.server.daemon
+
+        if self.path != '/runs':
+            self.send_error(404, 'Submit test runs to /runs')
+            return
+
+        try:
+            submission = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            config_name = submission['config']
+            test_run_name = submission['testRun']
+        except (ValueError, KeyError):
+            self.send_error(400, 'The body must be json with a config and a testRun')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        try:
+            summary = daemon.execute_test_run(config_name, test_run_name, self.stream_result)
+            self.stream_line(DaemonMessageType.SUMMARY, **summary)
+        except Exception as err:
+            self.stream_line(DaemonMessageType.ERROR, message=f'{type(err).__name__}: {err}')
+
+
+    def stream_line(self, message_type, **values):
+        ''' Writes one json line to the client. If the client went away the test run carries on, there is just nobody to tell. '''
+        values['type'] = message_type
+        try:
+            self.wfile.write(json.dumps(values).encode('utf-8') + b'\n')
+            self.wfile.flush()
+        except OSError:
+            pass
+
+
+    def stream_result(self, test_def: TestDefinition):
+        ''' The result listener of the executor, streams a finished test to the client. '''
+        self.stream_line(DaemonMessageType.RESULT, result=test_def.to_dict())
+
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        ''' Writes the request log above the progress bar instead of through it. '''
+        tqdm.write(f'{self.address_string()} - {format % args}')
+
+
+class Daemon:
+    '''
+        Serves test runs over localhost HTTP and keeps a warm worker pool for every executor config and test run it executed, so the
+        next submission of the same test run starts right away. Test runs are executed one at a time, in the order they came in.
+        The workers keep the test modules they imported, restart the daemon to pick up changes to the test suites.
+    '''
+    def __init__(self, address: str, root_dir: str):
+        self.host, self.port = MessageChannel.parse_address(address)
+        self.root_dir = root_dir
+        self.worker_pools: Dict[tuple, WorkerPool] = {} # (executor config, test run) -> warm pool
+        self.pool_parallel_tests: Dict[tuple, int] = {} # (executor config, test run) -> parallel tests the pool was started for
+        self.run_lock = threading.Lock()
+
+
+    def get_worker_pool(self, config_name, test_run_name, trav_con: TraverseConfig, executor: Executor):
+        '''
+            Returns the warm worker pool of the executor config and test run passed in, set up for this test run. A new pool is started
+            the first time, or if the number of parallel tests in the executor config changed.
+        '''
+        pool_key = (config_name, test_run_name)
+        initargs = (trav_con, executor.suite_records)
+        worker_pool = self.worker_pools.get(pool_key)
+
+        if worker_pool is not None and self.pool_parallel_tests[pool_key] != trav_con.parallel_tests:
+            worker_pool.close()
+            worker_pool = None
+
+        if worker_pool is None:
+            worker_pool = WorkerPool(trav_con.parallel_tests +1, Executor.execute_tasks, WorkerCache.init_worker, initargs,
+                                     WorkerCache.shutdown_worker, trav_con.worker_max_tests, trav_con.worker_max_memory_mb)
+            self.worker_pools[pool_key] = worker_pool
+            self.pool_parallel_tests[pool_key] = trav_con.parallel_tests
+        else:
+            worker_pool.reinitialize(initargs)
+
+        return worker_pool
+
+
+    def execute_test_run(self, config_name, test_run_name, result_listener=None) -> Dict:
+        '''
+            Executes the test run the same way traverse.py does, on the warm worker pool of the test run. Every finished test is passed
+            to the result listener while the run is busy. Returns a summary of the test run.
+        '''
+        with self.run_lock:
+            trav_con = TraverseConfig.load(config_name, test_run_name, self.root_dir)
+            profiler = Profiler(trav_con)
+            cartesian = profiler.run_profiler(lazy=True)
+
+            executor = Executor(trav_con, cartesian, suite_records=profiler.suite_records)
+            reporter = Reporter(trav_con)
+            executor.add_result_listener(reporter.add_executor_result)
+            if result_listener is not None:
+                executor.add_result_listener(result_listener)
+
+            worker_pool = self.get_worker_pool(config_name, test_run_name, trav_con, executor)
+            try:
+                completed_tests = executor.run_executor(worker_pool, close_pool=False)
+            except Exception:
+                # A pool which a test run broke off in the middle of might still be busy, it is not reused
+                worker_pool.close()
+                del self.worker_pools[(config_name, test_run_name)]
+                raise
+
+            reporter.close_report()
+
+        # Quarantined tests are known to be flaky, they are counted on their own like the report does
+        main_tests = [test_def for test_def in completed_tests if not test_def.quarantined]
+        return {
+            'testRunName': trav_con.test_run_name,
+            'resultDir': trav_con.testrun_result_dir,
+            'total': len(main_tests),
+            'passed': sum(test_def.test_status == TestStatus.PASSED for test_def in main_tests),
+            'failed': sum(test_def.test_status == TestStatus.FAILED for test_def in main_tests),
+            'blocked': sum(test_def.test_status == TestStatus.BLOCKED for test_def in main_tests),
+            'quarantined': len(completed_tests) - len(main_tests)
+        }
+
+
+    def run_daemon(self, warm_up=None):
+        '''
+            The main entry into the daemon, serves test runs until it is stopped with ctrl+c. Pass in an (executor config, test run)
+            tuple as warm up to start its worker pool before the first submission comes in.
+        '''
+        if warm_up is not None:
+            config_name, test_run_name = warm_up
+            trav_con = TraverseConfig.load(config_name, test_run_name, self.root_dir)
+            profiler = Profiler(trav_con)
+            executor = Executor(trav_con, profiler.run_profiler(lazy=True), suite_records=profiler.suite_records)
+            self.get_worker_pool(config_name, test_run_name, trav_con, executor)
+
+        server = ThreadingHTTPServer((self.host, self.port), DaemonRequestHandler)
+        server.daemon_threads = True
+        server.daemon = self
+        tqdm.write(f'\nDaemon listening on http://{self.host}:{self.port}/runs, press ctrl+c to stop it.')
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for worker_pool in self.worker_pools.values():
+                worker_pool.close()
+            tqdm.write('\nDaemon stopped.')
+
+
+    @staticmethod
+    def submit_test_run(address: str, config_name, test_run_name):
+        '''
+            Submits a test run to the daemon on the address passed in and reports every test to the console as its result comes in.
+            Returns the summary of the test run.
+        '''
+        host, port = MessageChannel.parse_address(address)
+        connection = http.client.HTTPConnection(host, port)
+        connection.request('POST', '/runs', json.dumps({'config': config_name, 'testRun': test_run_name}),
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+
+        if response.status != 200:
+            raise Exception(f'The daemon did not accept the test run: {response.status} {response.reason}')
+
+        try:
+            for line in response:
+                message = json.loads(line)
+                if message['type'] == DaemonMessageType.RESULT:
+                    ReporterTasks.report_test_via_cmd(TestDefinition.from_dict(message['result']))
+                elif message['type'] == DaemonMessageType.SUMMARY:
+                    return message
+                else:
+                    raise Exception(f"The test run failed on the daemon: {message['message']}")
+        finally:
+            connection.close()
+
+        raise Exception('The daemon closed the connection before the test run finished.')
@@ -0,0 +1,213 @@
+''' Test discovery finds the test cases of test suites without importing them. The suite files are parsed instead, and the discovery
+    index remembers the test cases found in every suite file, so planning a test run does not import every test suite (and everything
+    they import) just to find out which tests it has. The index is stored as a json file in the history folder. '''
+import os
+import ast
+import json
+import hashlib
+from typing                 import Dict, List
+from core.core_models       import TraverseConfig, SuiteHooks
+from utilities.json_helper  import LoadJson
+
+INDEX_FILE_NAME = 'discovery_index.json'
+INDEX_VERSION = 2 # Bumped whenever what is kept per test case changes, an index of another version is scanned again
+
+
+class DiscoveryBackend:
+    ''' A holding class for the ways the profiler can find the test cases of a test suite, set with testDiscovery in the executor config. '''
+    AST = 'ast' # Parse the suite file, only import suites which build their tests at runtime
+    IMPORT = 'import' # Always import the suite and look at its Tests class
+
+
+class SuiteParser:
+    '''
+        Finds the test cases of a test suite by parsing its file with ast, no test code is imported or executed. The test cases are
+        the public methods of the Tests class, the same ones importing the suite would find. A suite which could add or change test
+        cases at runtime is left to an import, see get_test_cases.
+    '''
+    NOT_CALLABLE_DECORATORS = ('property', 'cached_property') # Decorated methods which are not test cases
+    TAGS_DECORATOR = 'tags' # See core.test_selection.tags
+
+    @staticmethod
+    def get_test_cases(suite_file) -> Dict[str, Dict]:
+        '''
+            Returns the test cases in the suite file passed in, sorted like dir() sorts them, each with the tags declared on it and
+            whether it is an async def method, like {"login": {"tags": ["smoke"], "isAsync": false}}. None is returned if the tests
+            can not be told from the file alone: the file does not parse, there is no Tests class of its own, the class inherits from
+            another class, is decorated, has test cases assigned or defined conditionally, or is changed later on, or a test case has
+            tags which are not plain strings.
+        '''
+        try:
+            with open(suite_file, 'rb') as open_file:
+                module_tree = ast.parse(open_file.read(), filename=suite_file)
+        except (OSError, SyntaxError, ValueError):
+            return None
+
+        test_classes = [node for node in module_tree.body if isinstance(node, ast.ClassDef) and node.name == 'Tests']
+        if len(test_classes) != 1 or SuiteParser._is_changed_outside(module_tree, test_classes[0]):
+            return None
+
+        test_class = test_classes[0]
+        if len(test_class.decorator_list) > 0 or len(test_class.keywords) > 0 \
+           or any(not (isinstance(base, ast.Name) and base.id == 'object') for base in test_class.bases):
+            return None
+
+        test_cases = {}
+        for node in test_class.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if not node.name.startswith('_') and node.name not in (SuiteHooks.SETUP, SuiteHooks.TEARDOWN) \
+                   and not any(SuiteParser._get_decorator_name(decorator) in SuiteParser.NOT_CALLABLE_DECORATORS
+                               for decorator in node.decorator_list):
+                    test_tags = SuiteParser._get_test_tags(node)
+                    if test_tags is None:
+                        return None
+                    test_cases[node.name] = {'tags': test_tags, 'isAsync': isinstance(node, ast.AsyncFunctionDef)}
+                else:
+                    test_cases.pop(node.name, None) # A later definition replaces an earlier one
+            elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+                # Plain values like a timeout or a list of names are fine, anything else could be a test case built at runtime
+                if node.value is not None:
+                    try:
+                        ast.literal_eval(node.value)
+                    except (ValueError, TypeError, SyntaxError, RecursionError):
+                        return None
+            elif not isinstance(node, (ast.Expr, ast.Pass)):
+                return None
+
+        return {test_name: test_cases[test_name] for test_name in sorted(test_cases)}
+
+
+    @staticmethod
+    def _get_test_tags(test_method: ast.FunctionDef) -> List[str]:
+        ''' Returns the tags of the tags decorators on the test method passed in, or None if a tag is not a plain string. '''
+        test_tags = []
+        for decorator in test_method.decorator_list:
+            if not isinstance(decorator, ast.Call) or SuiteParser._get_decorator_name(decorator) != SuiteParser.TAGS_DECORATOR:
+                continue
+            if len(decorator.keywords) > 0 \
+               or any(not (isinstance(arg, ast.Constant) and isinstance(arg.value, str)) for arg in decorator.args):
+                return None
+            test_tags.extend(arg.value for arg in decorator.args)
+        return test_tags
+
+
+    @staticmethod
+    def _get_decorator_name(decorator: ast.expr):
+        ''' Returns the name of the decorator passed in, like property for @property or cached_property for @functools.cached_property. '''
+        if isinstance(decorator, ast.Call):
+            decorator = decorator.func
+        if isinstance(decorator, ast.Attribute):
+            return decorator.attr
+        if isinstance(decorator, ast.Name):
+            return decorator.id
+        return None
+
+
+    @staticmethod
+    def _is_changed_outside(module_tree: ast.Module, test_class: ast.ClassDef):
+        ''' Returns True if the module changes the Tests class outside of its class body, like Tests.test_x = ... or setattr(Tests, ...). '''
+        for node in ast.walk(module_tree):
+            if node is test_class:
+                continue
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('setattr', 'delattr') \
+               and len(node.args) > 0 and isinstance(node.args[0], ast.Name) and node.args[0].id == 'Tests':
+                return True
+            if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign, ast.Delete)):
+                targets = node.targets if isinstance(node, (ast.Assign, ast.Delete)) else [node.target]
+                if any(isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name) and target.value.id == 'Tests'
+                       for target in targets):
+                    return True
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef, ast.Import, ast.ImportFrom)) \
+               and node is not test_class and SuiteParser._binds_name(node, 'Tests'):
+                return True
+        return False
+
+
+    @staticmethod
+    def _binds_name(node: ast.stmt, name):
+        ''' Returns True if the class, function or import statement passed in binds the name passed in. '''
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            return any((alias.asname or alias.name) == name for alias in node.names)
+        return node.name == name
+
+
+class DiscoveryIndex:
+    '''
+        Keeps the test cases of every test suite file, with their tags and whether they are async, keyed by the path of the file
+        along with its mtime and content hash. A suite file with the same mtime is not read at all, one with a new mtime is only
+        scanned again if its content changed. A test suite which builds its tests from another module is not rescanned when only
+        that module changes, delete the index file to force a full scan.
+    '''
+    def __init__(self, traverse_config: TraverseConfig):
+        self.trav_con = traverse_config
+        self.index_file = os.path.join(self.trav_con.history_folder, INDEX_FILE_NAME)
+        self.suites: Dict[str, Dict] = {}
+        self.changed = False
+
+        if os.path.exists(self.index_file):
+            try:
+                index_json = LoadJson.using_filepath(self.index_file)
+                if index_json.get('version') == INDEX_VERSION:
+                    self.suites = index_json.get('suites', {})
+            except json.JSONDecodeError: # A broken index only costs one full scan, start again
+                pass
+
+
+    @staticmethod
+    def get_content_hash(suite_file):
+        ''' Returns the sha256 of the suite file passed in. '''
+        with open(suite_file, 'rb') as open_file:
+            return hashlib.sha256(open_file.read()).hexdigest()
+
+
+    def get_test_cases(self, suite_file) -> Dict[str, Dict]:
+        ''' Returns the test cases the index holds for the suite file passed in, or None if it has to be scanned. '''
+        suite_key = os.path.abspath(suite_file)
+        suite_entry = self.suites.get(suite_key)
+        if suite_entry is None:
+            return None
+
+        try:
+            mtime = os.path.getmtime(suite_file)
+        except OSError:
+            return None
+
+        if suite_entry['mtime'] == mtime:
+            return suite_entry['testCases']
+
+        # The file was touched, it only has to be scanned again if what is in it changed
+        if suite_entry['contentHash'] != self.get_content_hash(suite_file):
+            return None
+
+        suite_entry['mtime'] = mtime
+        self.changed = True
+        return suite_entry['testCases']
+
+
+    def set_test_cases(self, suite_file, test_cases: Dict[str, Dict]):
+        ''' Adds the test cases found by scanning the suite file passed in to the index, see SuiteParser.get_test_cases. '''
+        self.suites[os.path.abspath(suite_file)] = {
+            'mtime': os.path.getmtime(suite_file),
+            'contentHash': self.get_content_hash(suite_file),
+            'testCases': test_cases
+        }
+        self.changed = True
+
+
+    def save(self):
+        ''' Writes the index to disk if anything changed, suite files which no longer exist are dropped from it. '''
+        for suite_key in [suite_key for suite_key in self.suites if not os.path.exists(suite_key)]:
+            del self.suites[suite_key]
+            self.changed = True
+
+        if self.changed is False:
+            return
+
+        os.makedirs(self.trav_con.history_folder, exist_ok=True)
+        temp_file = f'{self.index_file}.tmp'
+
+        with open(temp_file, 'w') as file_out:
+            json.dump({'version': INDEX_VERSION, 'suites': self.suites}, file_out, indent=4)
+
+        os.replace(temp_file, self.index_file)
+        self.changed = False
@@ -0,0 +1,369 @@
+''' The distributor lets a test run execute on more than one machine. The coordinator serves the tests of a test run over TCP, agents
+    on other machines (or the same machine) pull work from it, execute it on their own worker pool and report the results back. '''
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import socketserver
+from collections            import deque
+from datetime               import datetime
+from typing                 import Dict, List
+
+from tqdm                   import tqdm
+from core.core_models       import TraverseConfig, SuiteRecord, TestTask, TestResult
+from core.test_worker       import WorkerCache, WorkerPool, WorkOutcome
+from core.test_executor     import Executor
+
+
+class MessageType:
+    ''' A holding class for the types of messages sent between the coordinator and its agents. '''
+    HELLO = 'hello'
+    SETUP = 'setup'
+    READY = 'ready'
+    WORK = 'work'
+    RESULTS = 'results'
+    HEARTBEAT = 'heartbeat'
+    DONE = 'done'
+    JOINED = 'joined' # Only used inside the coordinator, never sent
+    LOST = 'lost' # Only used inside the coordinator, never sent
+
+
+class MessageChannel:
+    ''' Sends and receives json messages over a socket, one message per line. Sending is thread safe. '''
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.stream = sock.makefile('rwb')
+        self.send_lock = threading.Lock()
+
+
+    @staticmethod
+    def parse_address(address: str):
+        ''' Splits an address like localhost:8500 into its host and port. '''
+        host, _, port = address.rpartition(':')
+        if host == '' or not port.isdigit():
+            raise Exception(f'Invalid address {address}, it must look like host:port')
+        return host, int(port)
+
+
+    def send(self, message_type, **values):
+        ''' Sends a message of the type passed in, any keyword arguments are added to the message. '''
+        values['type'] = message_type
+        with self.send_lock:
+            self.stream.write(json.dumps(values).encode('utf-8') + b'\n')
+            self.stream.flush()
+
+
+    def receive(self) -> Dict:
+        '''
+            Waits for the next message and returns it. None is returned once the other side closed the connection, or this side
+            closed it while waiting.
+        '''
+        try:
+            line = self.stream.readline()
+        except (OSError, ValueError): # ValueError is raised if the stream was closed while reading from it
+            return None
+
+        if not line:
+            return None
+        return json.loads(line)
+
+
+    def close(self):
+        '''
+            Closes the connection, errors are ignored because the other side might already be gone. The socket is shut down first,
+            so a thread waiting in receive gets the end of the connection instead of reading from a closed stream.
+        '''
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        try:
+            self.stream.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RemoteAgent:
+    ''' The coordinator's view of a connected agent, the work it leased and when it was last heard from. '''
+    def __init__(self, agent_name, channel: MessageChannel):
+        self.agent_name = agent_name
+        self.channel = channel
+        self.last_seen = time.monotonic()
+        self.leases = {} # Lease id -> (work item, started at)
+        self.lost = False
+
+
+class AgentHandler(socketserver.BaseRequestHandler):
+    ''' Handles the connection of one agent. Every message the agent sends is passed on to the coordinator as an event. '''
+    def handle(self):
+        coordinator: Coordinator = self.server.coordinator
+        channel = MessageChannel(self.request)
+
+        hello = channel.receive()
+        if hello is None or hello['type'] != MessageType.HELLO:
+            channel.close()
+            return
+
+        agent = RemoteAgent(hello['agentName'], channel)
+        channel.send(MessageType.SETUP, **coordinator.setup_message)
+        coordinator.events.put((MessageType.JOINED, agent, hello))
+
+        while True:
+            message = channel.receive()
+            if message is None:
+                break
+
+            agent.last_seen = time.monotonic()
+            if message['type'] in (MessageType.READY, MessageType.RESULTS):
+                coordinator.events.put((message['type'], agent, message))
+
+        coordinator.events.put((MessageType.LOST, agent, None))
+
+
+class Coordinator:
+    '''
+        Serves the tests of a test run to agents over TCP. The coordinator is passed to Executor.run_executor in place of the local
+        worker pool, so scheduling and retries work the same as a local test run. Agents pull work by telling the coordinator they have
+        a free slot, report results and send a heartbeat. When an agent disconnects or stops sending heartbeats, the work it leased is
+        handed back to the executor to run again.
+    '''
+    POLL_INTERVAL = 1 # Seconds
+    HEARTBEAT_TIMEOUT = 30 # Seconds without hearing from an agent before it is considered lost
+
+    def __init__(self, address: str, traverse_config: TraverseConfig, suite_records: Dict[str, SuiteRecord]):
+        host, port = MessageChannel.parse_address(address)
+        self.setup_message = {
+            'execConfig': traverse_config.exec_config,
+            'testRun': traverse_config.test_run,
+            'suiteRecords': [suite_record.to_dict() for suite_record in suite_records.values()]
+        }
+
+        # Agent connections are handled on their own threads, they only talk to the executor's thread through the events queue.
+        self.events = queue.Queue()
+        self.agents: List[RemoteAgent] = []
+        self.ready_slots = deque() # One entry per free slot of an agent
+        self.pending_outcomes = []
+        self.next_lease_id = 0
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), AgentHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        tqdm.write(f'\nCoordinator listening on {host}:{port}, waiting for agents to connect.')
+
+
+    def _handle_event(self, event):
+        ''' Handles an event from an agent connection. Any work outcomes it produces are added to the pending outcomes. '''
+        event_type, agent, message = event
+
+        if event_type == MessageType.JOINED:
+            self.agents.append(agent)
+            tqdm.write(f"\nAgent {agent.agent_name} joined with {message['slots']} slots.")
+
+        elif event_type == MessageType.READY:
+            if agent.lost is False:
+                self.ready_slots.append(agent)
+
+        elif event_type == MessageType.RESULTS:
+            work_item, started_at = agent.leases.pop(message['lease'], (None, None))
+            if work_item is not None:
+                test_results = [TestResult.from_dict(result_dict) for result_dict in message['results']]
+                self.pending_outcomes.append(WorkOutcome(work_item, test_results, None, started_at))
+
+        elif event_type == MessageType.LOST:
+            self._lose_agent(agent)
+
+
+    def _lose_agent(self, agent: RemoteAgent):
+        ''' Forgets about the agent passed in, the work it leased is handed back to be executed again. '''
+        if agent.lost is True:
+            return
+
+        agent.lost = True
+        tqdm.write(f'\nAgent {agent.agent_name} was lost, requeueing the {len(agent.leases)} work items it was busy with.')
+
+        for work_item, started_at in agent.leases.values():
+            self.pending_outcomes.append(WorkOutcome(work_item, None, None, started_at, requeue=True))
+
+        agent.leases = {}
+        self.ready_slots = deque(ready_agent for ready_agent in self.ready_slots if ready_agent is not agent)
+        agent.channel.close()
+
+
+    def _check_heartbeats(self):
+        ''' Loses any agent which has not been heard from within the heartbeat timeout. '''
+        for agent in self.agents:
+            if agent.lost is False and time.monotonic() - agent.last_seen > self.HEARTBEAT_TIMEOUT:
+                self._lose_agent(agent)
+
+
+    def _handle_waiting_events(self):
+        ''' Handles every event which is waiting, without blocking. '''
+        while True:
+            try:
+                self._handle_event(self.events.get_nowait())
+            except queue.Empty:
+                return
+
+
+    def has_idle_worker(self):
+        ''' Returns True if any agent has a free slot. '''
+        self._handle_waiting_events()
+        return len(self.ready_slots) > 0
+
+
+    def is_busy(self):
+        ''' Returns True while any agent is busy with leased work or there are outcomes which were not collected yet. '''
+        return len(self.pending_outcomes) > 0 or any(len(agent.leases) > 0 for agent in self.agents)
+
+
+    def submit(self, work_item: List[TestTask], timeout=None):
+        ''' Leases the work item to an agent with a free slot. The agent enforces the timeout on its own worker pool. '''
+        agent = self.ready_slots.popleft()
+        lease_id = self.next_lease_id
+        self.next_lease_id += 1
+        agent.leases[lease_id] = (work_item, datetime.now())
+
+        try:
+            agent.channel.send(MessageType.WORK, lease=lease_id, tasks=[test_task.to_dict() for test_task in work_item], timeout=timeout)
+        except OSError:
+            self._lose_agent(agent)
+
+
+    def get_results(self, timeout=None) -> List[WorkOutcome]:
+        '''
+            Waits until work comes back from an agent, work is requeued or an agent gets a free slot and returns the work outcomes.
+            The list can be empty when only a slot came free, so the executor gets the chance to hand out more work.
+        '''
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+
+        while len(self.pending_outcomes) == 0:
+            try:
+                event = self.events.get(timeout=self.POLL_INTERVAL)
+                self._handle_event(event)
+                if event[0] == MessageType.READY:
+                    break
+            except queue.Empty:
+                pass
+
+            self._check_heartbeats()
+            if give_up_at is not None and time.monotonic() >= give_up_at:
+                break
+
+        self._handle_waiting_events()
+        work_outcomes = self.pending_outcomes
+        self.pending_outcomes = []
+        return work_outcomes
+
+
+    def close(self):
+        ''' Tells every agent the test run is done and stops listening. '''
+        for agent in self.agents:
+            if agent.lost is False:
+                try:
+                    agent.channel.send(MessageType.DONE)
+                except OSError:
+                    pass
+                agent.channel.close()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Agent:
+    '''
+        Connects to a coordinator, receives the configs of the test run from it and executes the work it is given on a local worker
+        pool with the number of slots passed in. The agent uses the tests, configs and drivers of its own copy of traverse.
+    '''
+    HEARTBEAT_INTERVAL = 5 # Seconds
+
+    def __init__(self, coordinator_address: str, slots: int, root_dir: str):
+        self.host, self.port = MessageChannel.parse_address(coordinator_address)
+        self.slots = slots
+        self.root_dir = root_dir
+        self.agent_name = f'{socket.gethostname()}-{os.getpid()}'
+        self.messages = queue.Queue()
+        self.stopped = threading.Event()
+
+
+    def _read_messages(self, channel: MessageChannel):
+        ''' Reads messages from the coordinator on a background thread. None is queued once the connection is gone. '''
+        while True:
+            message = channel.receive()
+            self.messages.put(message)
+            if message is None or message['type'] == MessageType.DONE:
+                return
+
+
+    def _send_heartbeats(self, channel: MessageChannel):
+        ''' Lets the coordinator know the agent is still alive, on a background thread, until the agent stops. '''
+        while not self.stopped.wait(self.HEARTBEAT_INTERVAL):
+            try:
+                channel.send(MessageType.HEARTBEAT)
+            except OSError:
+                return
+
+
+    def run_agent(self):
+        ''' The main entry into the agent, connects to the coordinator and executes work until the coordinator says the run is done. '''
+        channel = MessageChannel(socket.create_connection((self.host, self.port)))
+        channel.send(MessageType.HELLO, agentName=self.agent_name, slots=self.slots)
+
+        setup = channel.receive()
+        if setup is None or setup['type'] != MessageType.SETUP:
+            raise Exception('The coordinator did not send the test run setup.')
+
+        threading.Thread(target=self._send_heartbeats, args=(channel,), daemon=True).start()
+
+        trav_con = TraverseConfig(setup['execConfig'], setup['testRun'], self.root_dir)
+        suite_records = {}
+        for suite_dict in setup['suiteRecords']:
+            suite_record = SuiteRecord.from_dict(suite_dict, trav_con)
+            suite_records[SuiteRecord.key_for(suite_record.test_pack, suite_record.test_suite)] = suite_record
+
+        worker_pool = WorkerPool(self.slots, Executor.execute_tasks, WorkerCache.init_worker, (trav_con, suite_records),
+                                 WorkerCache.shutdown_worker, trav_con.worker_max_tests, trav_con.worker_max_memory_mb)
+        threading.Thread(target=self._read_messages, args=(channel,), daemon=True).start()
+        tqdm.write(f'\nAgent {self.agent_name} connected to {self.host}:{self.port} with {self.slots} slots.')
+
+        leases = {} # Test id of the first task in a work item -> lease id
+        for _ in range(self.slots):
+            channel.send(MessageType.READY)
+
+        try:
+            while True:
+                try:
+                    # Only wait on the coordinator when there is nothing running, otherwise check on the workers
+                    if worker_pool.is_busy():
+                        message = self.messages.get_nowait()
+                    else:
+                        message = self.messages.get(timeout=WorkerPool.POLL_INTERVAL)
+                except queue.Empty:
+                    message = False
+
+                if message is None or (message is not False and message['type'] == MessageType.DONE):
+                    break
+
+                if message is not False and message['type'] == MessageType.WORK:
+                    work_item = [TestTask.from_dict(task_dict) for task_dict in message['tasks']]
+                    leases[work_item[0].test_id] = message['lease']
+                    worker_pool.submit(work_item, message['timeout'])
+                    continue
+
+                if worker_pool.is_busy():
+                    for work_outcome in worker_pool.get_results(timeout=WorkerPool.POLL_INTERVAL):
+                        test_results = Executor.get_outcome_results(work_outcome)
+                        channel.send(MessageType.RESULTS, lease=leases.pop(work_outcome.work_item[0].test_id),
+                                     results=[test_result.to_dict() for test_result in test_results])
+                        channel.send(MessageType.READY)
+        finally:
+            self.stopped.set()
+            worker_pool.close()
+            channel.close()
+            tqdm.write(f'\nAgent {self.agent_name} finished.')
@@ -1,166 +1,603 @@
 ''' This is the executor module. It handles anything realted to test execution, singlular, bulk and on the go reporting if its configured. '''
-import sys
 import os
 import traceback
-import importlib
 import platform
+import asyncio
+import inspect
+import itertools
 
-from typing             import List
+from typing             import List, Dict, Callable, Iterable
+from collections        import deque, Counter
 from datetime           import datetime
-from multiprocessing    import Pool
 
-import pyautogui
+import psutil
 
 from tqdm               import tqdm
-from core.core_models   import TestStatus, TestDefinition, TraverseConfig
+from core.core_models   import TestStatus, TestDefinition, TraverseConfig, SuiteRecord, TestTask, TestResult
 from core.test_reporter import ReporterTasks
+from core.test_worker   import WorkerCache, WorkerPool, WorkOutcome
+from core.test_history  import TestHistory
+from core.test_journal  import ResultsJournal
+from core.test_pool_sizer import PoolSizer
 
 
 class Executor:
     ''' This is the main Executor class. By initialising this class, it accepts the traverse config and tests cartesian product.
         You can then call the run_executor method and it takes care of the rest.  '''
-    def __init__(self, traverse_config: TraverseConfig, tests_cartesian: List[TestDefinition]):
+    ASYNC_BATCH_GRACE = 30 # Seconds a batch of async tests gets on top of its test timeout before its worker is killed
+
+    def __init__(self, traverse_config: TraverseConfig, tests_cartesian: Iterable[TestDefinition], update_history=True,
+                 suite_records: Dict[str, SuiteRecord] = None):
         self.trav_con = traverse_config
-        self.t_cartesian = tests_cartesian
+        self.t_lookup: Dict[int, TestDefinition] = {}
+        self.test_history: TestHistory = None # Loaded the first time it is needed, see get_test_history
+        self.update_history = update_history # Shards leave the history alone, it is updated when their results are merged
+        self.result_listeners: List[Callable[[TestDefinition], None]] = []
+        self.flakiness_scores = {}
+
+        # A list of tests is planned as a whole. Any other iterable, like the generator of a lazy profiler, is taken a batch at a time
+        # while the run is busy, so the first test starts before the rest of the cartesian product is created.
+        if isinstance(tests_cartesian, list):
+            self.t_cartesian = tests_cartesian
+            self.t_source = None
+        else:
+            self.t_cartesian = []
+            self.t_source = iter(tests_cartesian)
+
+        # Values shared by a whole test suite are only sent to the workers once, tests are sent as lean test tasks. The workers get
+        # the suite records when they start, so the suite records of a lazy cartesian product must be passed in.
+        self.suite_records = dict(suite_records) if suite_records is not None else {}
+        self.add_tests(self.t_cartesian)
+
+
+    def add_tests(self, test_defs: List[TestDefinition]):
+        ''' Adds the test definitions passed in to the tests of the run, with the suite record of their suite. '''
+        for test_def in test_defs:
+            self.t_lookup[test_def.test_id] = test_def
+
+            suite_key = SuiteRecord.key_for(test_def.test_pack, test_def.test_suite)
+            if suite_key not in self.suite_records:
+                self.suite_records[suite_key] = SuiteRecord.from_test_definition(test_def)
+
+            # Known flaky tests are quarantined, they run in their own low priority lane so they do not hold up the rest of the run
+            if self.trav_con.quarantine_enabled is True:
+                flakiness_score = self.get_test_history().get_flakiness_score(test_def, self.trav_con.flakiness_min_runs)
+                if flakiness_score is not None and flakiness_score >= self.trav_con.flakiness_threshold:
+                    test_def.quarantined = True
+                    self.flakiness_scores[test_def.test_id] = flakiness_score
+
+
+    def get_test_history(self) -> TestHistory:
+        '''
+            Returns the test history, it is loaded from disk the first time it is needed. Workers create an executor for every work
+            item they execute and never need the history, so they do not pay for reading it.
+        '''
+        if self.test_history is None:
+            self.test_history = TestHistory(self.trav_con)
+        return self.test_history
+
+
+    def take_tests(self) -> List[TestDefinition]:
+        ''' Takes the next batch of tests out of the lazy cartesian product and returns them, an empty list once it ran out. '''
+        if self.t_source is None:
+            return []
+
+        test_defs = list(itertools.islice(self.t_source, self.trav_con.lazy_batch_size))
+        if len(test_defs) < self.trav_con.lazy_batch_size:
+            self.t_source = None
 
+        for test_def in test_defs:
+            if SuiteRecord.key_for(test_def.test_pack, test_def.test_suite) not in self.suite_records:
+                raise Exception(f'The test {test_def.test_name} is in {test_def.test_pack}/{test_def.test_suite}, which is not in the suite '
+                                'records passed to the executor. The suite records of a lazy test run must be passed in.')
 
-    def run_executor(self) -> List[TestDefinition]:
+        self.add_tests(test_defs)
+        return test_defs
+
+
+    def add_result_listener(self, result_listener: Callable[[TestDefinition], None]):
+        ''' Adds a function which is called with every test definition as soon as the test finished, while the run is still busy. '''
+        self.result_listeners.append(result_listener)
+
+
+    def run_executor(self, worker_pool=None, close_pool=True) -> List[TestDefinition]:
         ''' The main method for the Executor class, by initialising the Executor class, all you would do to execute your
-            tests, is call this method, and the tests will all be executed. '''
-        num_of_retries = self.trav_con.test_retries
-        pool = Pool(self.trav_con.parallel_tests +1) # Add one, because if you set it to 0, you don't want parallel processing
+            tests, is call this method, and the tests will all be executed. By default the tests run on a local worker pool, pass in
+            another pool (like the Coordinator, which hands the tests to agents on other machines) to execute them somewhere else.
+            Pass in close_pool as False to keep the pool passed in running after the test run, like the daemon does with its warm pools.
+            Quarantined tests get the quarantine workers of the executor config, and any other worker no other test is waiting for.
+            Once the other tests are done the quarantined tests which did not start yet are not executed, unless the pool is too
+            small to keep a worker for them, then they run after the other tests. The tests of a lazy
+            cartesian product are taken lazy batch size at a time whenever the queue runs low, they are scheduled by duration within
+            their batch. The profiler creates the tests expected to take the longest first, so the batches are in that order too. '''
+        # Adaptive workers size the local pool going by the load of the machine, the pool of a coordinator is its agents
+        pool_sizer = None
+        if self.trav_con.adaptive_workers is True and (worker_pool is None or isinstance(worker_pool, WorkerPool)):
+            pool_sizer = PoolSizer(self.trav_con)
+
+        if worker_pool is None:
+            # Add one, because if you set it to 0, you don't want parallel processing. Workers are warmed up once by the initializer.
+            num_of_workers = pool_sizer.get_initial_size() if pool_sizer is not None else self.trav_con.parallel_tests +1
+            worker_pool = WorkerPool(num_of_workers, Executor.execute_tasks, WorkerCache.init_worker,
+                                     (self.trav_con, self.suite_records), WorkerCache.shutdown_worker,
+                                     self.trav_con.worker_max_tests, self.trav_con.worker_max_memory_mb)
+        elif pool_sizer is not None:
+            worker_pool.resize(pool_sizer.get_initial_size())
         completed_tests = []
-        incomplete_tests = []
+        # Every finished test goes in the journal straight away, so a crash does not lose the results of the run so far
+        results_journal = ResultsJournal(self.trav_con.testrun_result_dir)
+
+        # A test waits until every test it depends on passed. Dependencies which are not part of this run are not waited for.
+        pending_dependencies = {test_def.test_id: {dependency_id for dependency_id in test_def.depends_on if dependency_id in self.t_lookup}
+                                for test_def in self.t_cartesian}
+        dependents = {}
+        for test_id, dependency_ids in pending_dependencies.items():
+            for dependency_id in dependency_ids:
+                dependents.setdefault(dependency_id, []).append(test_id)
+
+        ready_tests = [test_def for test_def in self.t_cartesian if len(pending_dependencies[test_def.test_id]) == 0]
+        for test_def in ready_tests:
+            del pending_dependencies[test_def.test_id]
+
+        # Work items are only handed to the pool when a worker is free, so a failed test can go back in the queue straight away
+        # and is retried while the rest of the run is still busy. Quarantined tests have their own queue, the quarantine lane.
+        work_queue = deque(self.get_work_items(self.get_scheduled_tests([test_def for test_def in ready_tests if not test_def.quarantined])))
+        quarantine_queue = deque(self.get_work_items(self.get_scheduled_quarantine([test_def for test_def in ready_tests if test_def.quarantined])))
+        main_tests_left = sum(not test_def.quarantined for test_def in self.t_cartesian)
+        main_tests_total = main_tests_left
+        quarantine_only = main_tests_total == 0 and self.t_source is None # If every test is quarantined the quarantine lane is the whole run
+        # How much of each concurrency limit the running work items use
+        running_usage = Counter()
+        running_quarantined = 0
 
-        while num_of_retries >= 0:
-            if num_of_retries < self.trav_con.test_retries:
-                print(f'\nSome tests failed. Retrying them. {num_of_retries} retries are left\n')
+        try:
+            with tqdm(total=len(self.t_cartesian)) as progress_bar:
+                while main_tests_left > 0 or self.t_source is not None or worker_pool.is_busy() or \
+                        ((quarantine_only or self.is_quarantine_deferred(worker_pool)) and len(quarantine_queue) > 0):
+                    # The tests of a lazy cartesian product are taken whenever the queue runs low
+                    if self.t_source is not None and len(work_queue) <= self.trav_con.parallel_tests +1:
+                        new_tests = self.take_tests()
+                        main_tests_left += sum(not test_def.quarantined for test_def in new_tests)
+                        main_tests_total += sum(not test_def.quarantined for test_def in new_tests)
+                        work_queue.extend(self.get_work_items(self.get_scheduled_tests([test_def for test_def in new_tests if not test_def.quarantined])))
+                        quarantine_queue.extend(self.get_work_items(self.get_scheduled_quarantine([test_def for test_def in new_tests if test_def.quarantined])))
+                        progress_bar.total += len(new_tests)
+                        progress_bar.refresh()
+                        quarantine_only = main_tests_total == 0 and self.t_source is None
+
+                    if pool_sizer is not None:
+                        worker_pool.resize(pool_sizer.get_pool_size(worker_pool.target_size, len(work_queue) + len(quarantine_queue)))
+
+                    while worker_pool.has_idle_worker():
+                        work_item = None
+                        # The quarantine lane keeps some workers even on a busy run, so quarantined tests keep running and a test
+                        # which is no longer flaky can earn its way out of quarantine. At least one worker is always left for the
+                        # main queue, so with a single worker quarantined tests only run when the main queue is empty or blocked.
+                        if running_quarantined < self.get_reserved_quarantine_workers(worker_pool):
+                            work_item = self.get_next_work_item(quarantine_queue, running_usage)
+                        if work_item is None:
+                            work_item = self.get_next_work_item(work_queue, running_usage)
+                        if work_item is None and (main_tests_left > 0 or self.t_source is not None or quarantine_only or
+                                                  self.is_quarantine_deferred(worker_pool)):
+                            work_item = self.get_next_work_item(quarantine_queue, running_usage)
+                        if work_item is None: # Nothing queued fits the concurrency limits until a running test finishes
+                            break
+
+                        running_usage.update(self.get_work_item_usage(work_item))
+                        running_quarantined += self.is_quarantined(work_item)
+                        worker_pool.submit(work_item, self.get_work_item_timeout(work_item))
+
+                    test_results = []
+                    # With adaptive workers, the executor wakes up every sample interval even if no test finished
+                    for work_outcome in worker_pool.get_results(self.trav_con.sizing_interval if pool_sizer is not None else None):
+                        running_usage.subtract(self.get_work_item_usage(work_outcome.work_item))
+                        running_quarantined -= self.is_quarantined(work_outcome.work_item)
+                        if work_outcome.requeue is True:
+                            if self.is_quarantined(work_outcome.work_item):
+                                quarantine_queue.appendleft(work_outcome.work_item)
+                            else:
+                                work_queue.appendleft(work_outcome.work_item)
+                        else:
+                            test_results.extend(Executor.get_outcome_results(work_outcome))
+
+                    tests_to_retry = []
+                    tests_to_start = []
+                    finished_tests = deque()
+                    for test_result in test_results:
+                        result = test_result.apply_to(self.t_lookup[test_result.test_id])
+                        result.test_attempts += 1
+                        self.get_test_history().record_attempt(result)
+
+                        # Quarantined tests have their own retry budget
+                        test_retries = self.trav_con.quarantine_retries if result.quarantined else self.trav_con.test_retries
+                        retry_test = result.test_status not in (TestStatus.PASSED, TestStatus.BLOCKED) and result.test_attempts <= test_retries
+                        if retry_test:
+                            result.test_status = TestStatus.RETEST
+
+                        if self.trav_con.test_result_updates is True:
+                            ReporterTasks.report_test_via_cmd(result)
+
+                        if retry_test:
+                            result.comments = ''
+                            result.test_start_time = None
+                            result.test_end_time = None
+                            tests_to_retry.append(result)
+                        else:
+                            finished_tests.append(result)
 
-            if len(incomplete_tests) > 0:
-                tests_to_run = incomplete_tests
-                incomplete_tests = []
+                    while len(finished_tests) > 0:
+                        result = finished_tests.popleft()
+                        if result.quarantined:
+                            result.comments = f'Quarantined, flakiness score {self.flakiness_scores[result.test_id]:.2f}. ' + result.comments
+                        else:
+                            main_tests_left -= 1
+
+                        completed_tests.append(result)
+                        results_journal.record_result(result)
+                        self.get_test_history().record_result(result)
+                        progress_bar.update()
+                        for result_listener in self.result_listeners:
+                            result_listener(result)
+
+                        # Start the dependents which are not waiting on anything else, or block them all if this test did not pass
+                        for dependent_id in dependents.get(result.test_id, []):
+                            if dependent_id not in pending_dependencies: # Already blocked by another of its dependencies
+                                continue
+
+                            dependent = self.t_lookup[dependent_id]
+                            if result.test_status == TestStatus.PASSED:
+                                pending_dependencies[dependent_id].discard(result.test_id)
+                                if len(pending_dependencies[dependent_id]) == 0:
+                                    del pending_dependencies[dependent_id]
+                                    tests_to_start.append(dependent)
+                            else:
+                                del pending_dependencies[dependent_id]
+                                self.block_test(dependent, result)
+                                if self.trav_con.test_result_updates is True:
+                                    ReporterTasks.report_test_via_cmd(dependent)
+                                finished_tests.append(dependent)
+
+                    # Retries and tests which were waiting on others go to the front of their queue so they are not stuck behind the rest of the run
+                    tests_to_queue = tests_to_retry + self.get_scheduled_tests(tests_to_start)
+                    work_queue.extendleft(reversed(self.get_work_items([test_def for test_def in tests_to_queue if not test_def.quarantined])))
+                    quarantine_queue.extendleft(reversed(self.get_work_items([test_def for test_def in tests_to_queue if test_def.quarantined])))
+
+                # The run does not wait for the quarantine lane, unless it is deferred, quarantined tests which did not get a worker are
+                # left untested. They are not journaled, so a resumed run still executes them.
+                finished_test_ids = {test_def.test_id for test_def in completed_tests}
+                for test_def in self.t_lookup.values():
+                    if test_def.test_id not in finished_test_ids:
+                        test_def.test_status = TestStatus.UNTESTED
+                        test_def.comments = f'Quarantined, flakiness score {self.flakiness_scores[test_def.test_id]:.2f}. ' \
+                                            'Not executed, the rest of the run finished first.'
+                        completed_tests.append(test_def)
+                        progress_bar.update()
+                        for result_listener in self.result_listeners:
+                            result_listener(test_def)
+        except KeyboardInterrupt:
+            # Workers ignore ctrl+c, they are shut down here so they can clean up, instead of being killed when the executor exits
+            tqdm.write('\nThe test run was interrupted, waiting for the workers to shut down.')
+            close_pool = True
+            raise
+        finally:
+            # Let the workers shut down cleanly so anything they keep for the run, like pooled browser sessions, is closed
+            if close_pool is True:
+                worker_pool.close()
+            results_journal.close()
+
+        if self.update_history is True:
+            self.get_test_history().save()
+
+        return completed_tests
+
+
+    def get_scheduled_tests(self, test_defs: List[TestDefinition]) -> List[TestDefinition]:
+        '''
+            Returns the test definitions in the order they should be executed. If schedule by duration is enabled, the tests expected
+            to take the longest (going by the test history) are started first so they do not end up as a long tail at the end of the run.
+        '''
+        if self.trav_con.schedule_by_duration is not True:
+            return test_defs
+
+        expected_durations = self.get_test_history().get_expected_durations(test_defs)
+        return sorted(test_defs, key=lambda test_def: expected_durations[test_def.test_id], reverse=True)
+
+
+    def get_scheduled_quarantine(self, test_defs: List[TestDefinition]) -> List[TestDefinition]:
+        '''
+            Returns the quarantined test definitions in the order they should be executed, the one which ran the longest ago first.
+            The quarantine lane does not always get through all of its tests, this way every quarantined test gets its turn.
+        '''
+        test_history = self.get_test_history()
+        last_start_times = {test_def.test_id: (test_history.get_last_result(test_def) or {}).get('testStartTime') or ''
+                            for test_def in test_defs}
+        return sorted(test_defs, key=lambda test_def: last_start_times[test_def.test_id])
+
+
+    def get_work_items(self, test_defs: List[TestDefinition]) -> List[List[TestTask]]:
+        '''
+            Turns the test definitions into the work items sent to the pool. A normal test is a work item on its own, async tests are
+            batched together, up to async concurrency per batch, so one worker runs the whole batch at once on its event loop. Async
+            tests only share a batch with tests which count towards the same concurrency limits, and a batch never holds more tests
+            than those limits allow.
+        '''
+        work_items = []
+        async_tasks = {}
+
+        for test_def in test_defs:
+            test_task = TestTask.from_test_definition(test_def)
+            if self.is_async_test(test_def):
+                async_tasks.setdefault(tuple(sorted(self.get_work_item_usage([test_task]))), []).append(test_task)
             else:
-                tests_to_run = self.t_cartesian
+                work_items.append([test_task])
+
+        # Async batches go first, they spend most of their time waiting so they should not hold up the end of the run
+        async_batches = []
+        for usage_keys, tasks in async_tasks.items():
+            batch_size = min([self.trav_con.async_concurrency] + [self.get_concurrency_limit(usage_key) for usage_key in usage_keys])
+            async_batches.extend(tasks[index:index + batch_size] for index in range(0, len(tasks), batch_size))
+
+        return async_batches + work_items
+
 
-            for result in tqdm(pool.imap_unordered(self.execute_test, tests_to_run), total=len(tests_to_run)):
-                if self.trav_con.test_result_updates is True:
-                    ReporterTasks.report_test_via_cmd(result)
+    def is_quarantined(self, work_item: List[TestTask]):
+        ''' Returns True if the work item belongs to the quarantine lane, the tests of a work item are always in the same lane. '''
+        return self.t_lookup[work_item[0].test_id].quarantined
 
-                if result.test_status == TestStatus.PASSED or result.test_status == TestStatus.BLOCKED:
-                    completed_tests.append(result)
-                else:
-                    if num_of_retries > 0:
-                        result.comments = ''
-                        result.test_start_time = None
-                        result.test_end_time = None
 
-                    incomplete_tests.append(result)
+    def get_reserved_quarantine_workers(self, worker_pool):
+        ''' Returns how many workers the quarantine lane gets ahead of the main queue, never all of the workers of the pool.
+            A distributed run has no fixed pool size, so it keeps the configured number. '''
+        target_size = getattr(worker_pool, 'target_size', None)
+        if target_size is None:
+            return self.trav_con.quarantine_workers
+        return min(self.trav_con.quarantine_workers, max(target_size - 1, 0))
 
-            if len(incomplete_tests) <= 0:
-                break
 
-            num_of_retries = num_of_retries - 1
+    def is_quarantine_deferred(self, worker_pool):
+        ''' Returns True if the quarantine lane should have workers but the pool has none to spare, the quarantined tests then run
+            after the other tests instead of being left untested. '''
+        return self.trav_con.quarantine_workers > 0 and self.get_reserved_quarantine_workers(worker_pool) == 0
 
-        if len(incomplete_tests) > 0:
-            incomplete_tests.extend(completed_tests)
-            return incomplete_tests
+
+    def get_concurrency_limit(self, usage_key):
+        ''' Returns the concurrency limit of a usage key, like ('capability', 'firefox') or ('resourceTag', 'database'). '''
+        limit_type, name = usage_key
+        if limit_type == 'capability':
+            return self.trav_con.capability_limits[name]
+
+        return self.trav_con.resource_limits[name]
+
+
+    def get_work_item_usage(self, work_item: List[TestTask]) -> Dict:
+        '''
+            Returns how many tests of the work item count towards each concurrency limit of the executor config, keyed by usage key. A
+            test counts towards the limit of its capability and of every resource tag of its suite, if a limit is set for them.
+        '''
+        usage = Counter()
+        for test_task in work_item:
+            if test_task.capability in self.trav_con.capability_limits:
+                usage[('capability', test_task.capability)] += 1
+
+            for resource_tag in set(self.suite_records[test_task.suite_key].resource_tags): # A tag listed twice still counts once
+                if resource_tag in self.trav_con.resource_limits:
+                    usage[('resourceTag', resource_tag)] += 1
+
+        return usage
+
+
+    def get_next_work_item(self, work_queue: deque, running_usage: Counter):
+        '''
+            Takes the first work item out of the queue which fits in what is left of the concurrency limits and returns it. None is
+            returned if the queue is empty or no work item fits, a busy capability or resource tag does not hold up the tests behind it
+            in the queue. When nothing which counts towards the limits is running, no running test can make room, so the first work
+            item is returned even if it does not fit, instead of the run waiting forever.
+        '''
+        if len(work_queue) == 0:
+            return None
+
+        if len(self.trav_con.capability_limits) == 0 and len(self.trav_con.resource_limits) == 0:
+            return work_queue.popleft()
+
+        for index, work_item in enumerate(work_queue):
+            usage = self.get_work_item_usage(work_item)
+            if all(running_usage[usage_key] + count <= self.get_concurrency_limit(usage_key) for usage_key, count in usage.items()):
+                del work_queue[index]
+                return work_item
+
+        if not any(running_usage.values()):
+            tqdm.write('\nA test does not fit in the concurrency limits even on its own, running it anyway.')
+            return work_queue.popleft()
+
+        return None
+
+
+    def get_test_timeout(self, suite_record: SuiteRecord):
+        ''' Returns the timeout in seconds of the tests in the suite passed in, the suite json can override the executor config.
+            None is returned if there is no timeout. '''
+        test_timeout = suite_record.test_timeout if suite_record.test_timeout is not None else self.trav_con.test_timeout
+        return test_timeout if test_timeout > 0 else None
+
+
+    def get_work_item_timeout(self, work_item: List[TestTask]):
+        '''
+            Returns how long the worker may take to finish the work item before it is killed. Async tests in a batch run at the same
+            time and time out on their own, so the batch gets the longest timeout of its tests and a bit of time to report back.
+        '''
+        test_timeouts = [self.get_test_timeout(self.suite_records[test_task.suite_key]) for test_task in work_item]
+        if None in test_timeouts:
+            return None
+
+        if self.is_async_test(self.t_lookup[work_item[0].test_id]):
+            return max(test_timeouts) + self.ASYNC_BATCH_GRACE
+
+        return test_timeouts[0]
+
+
+    @staticmethod
+    def get_outcome_results(work_outcome: WorkOutcome) -> List[TestResult]:
+        ''' Returns the test results of a work outcome. If the worker failed, every test of the work item is failed with its comment. '''
+        if work_outcome.results is not None:
+            return work_outcome.results
+
+        return [TestResult(test_task.test_id, TestStatus.FAILED, work_outcome.started_at, datetime.now(), work_outcome.failure_comment)
+                for test_task in work_outcome.work_item]
+
+
+    @staticmethod
+    def execute_tasks(test_tasks: List[TestTask]) -> List[TestResult]:
+        '''
+            The entry point of a pool worker. The test tasks are turned back into full test definitions using the worker cache, the tests
+            are executed and only the lean results are sent back. A static method so the pool does not pickle the executor with every test.
+            A batch of async tests is executed at once on the event loop of the worker. The memory of the worker is recorded before and
+            after every test, the tests of an async batch share the memory before and after the whole batch.
+        '''
+        executor = Executor(WorkerCache.trav_con, [])
+        test_defs = [WorkerCache.get_test_definition(test_task) for test_task in test_tasks]
+        worker_process = psutil.Process()
+
+        if executor.is_async_test(test_defs[0]):
+            memory_before = worker_process.memory_info().rss
+            test_defs = WorkerCache.get_event_loop().run_until_complete(executor.execute_tests_async(test_defs))
+            memory_after = worker_process.memory_info().rss
+            for test_def in test_defs:
+                test_def.memory_before = memory_before
+                test_def.memory_after = memory_after
         else:
-            return completed_tests
+            for test_def in test_defs:
+                test_def.memory_before = worker_process.memory_info().rss
+                executor.execute_test(test_def)
+                test_def.memory_after = worker_process.memory_info().rss
+
+        return [TestResult.from_test_definition(test_def) for test_def in test_defs]
 
 
     def execute_test(self, test_def: TestDefinition) -> TestDefinition:
         ''' This method will execute a test based on the test definition passed into it. This method only executes 1 test. '''
+        # Start the Timer
+        start_time = datetime.now()
+        init_test_class = None
         try:
-            # Start the Timer
-            start_time = datetime.now()
             # Setup before starting with the test
             test_def = self.pre_test_setup(test_def)
             if test_def.test_status == TestStatus.BLOCKED:
                 return self.update_test_definition(test_def, start_time)
-            else:
-                # First get the test module .py file
-                test_module = importlib.import_module(f'tests.{test_def.test_pack}.{test_def.test_suite}')
-                # Get the test class out of the module and store it in a var
-                test_class = getattr(test_module, 'Tests')
-                # Initialise and store in a var the test class, not forgetting to pass it the required arguments
-                init_test_class = test_class(self.trav_con, test_def)
-                # Get the function under test to execute - Its the raw function, this doesnt execute it, only loads its definition into mem
-                test_func = getattr(test_class, test_def.test_name)
-
-                # Execute the test
-                test_func(init_test_class)
-
-                # If we make it here it didn't fail, so its a pass, hopefully the test is written to fail correctly for issues :)
-                test_def.test_status = TestStatus.PASSED
-                return self.update_test_definition(test_def, start_time)
 
-        except AssertionError:
-            test_def.test_status = TestStatus.FAILED
-            _, _, trace_back = sys.exc_info()
-            traceback.print_tb(trace_back) # Fixed format
-            tb_info = traceback.extract_tb(trace_back)
-            _, line, _, text = tb_info[-1]
-            test_def.comments = test_def.comments + 'Assertion error on line {} in statement {}'.format(line, text)
+            init_test_class, test_func = self.load_test(test_def)
 
-            return self.update_test_definition(test_def, start_time)
+            # Execute the test
+            test_func(init_test_class)
 
-        except TimeoutError:
-            test_def.test_status = TestStatus.FAILED
-            test_def.comments = test_def.comments + 'Timeout Error'
+            # If we make it here it didn't fail, so its a pass, hopefully the test is written to fail correctly for issues :)
+            test_def.test_status = TestStatus.PASSED
+            return self.update_test_definition(test_def, start_time)
 
+        except Exception as err:
+            self.fail_test(test_def, err)
             return self.update_test_definition(test_def, start_time)
 
-        except TypeError:
-            test_def.test_status = TestStatus.FAILED
-            _, _, trace_back = sys.exc_info()
-            traceback.print_tb(trace_back) # Fixed format
-            tb_info = traceback.extract_tb(trace_back)
-            _, line, _, text = tb_info[-1]
-            test_def.comments = test_def.comments + 'Type error on line {} in statement {}'.format(line, text)
+        finally:
+            self.post_test_cleanup(test_def, init_test_class)
 
-            return self.update_test_definition(test_def, start_time)
 
-        except KeyError:
-            test_def.test_status = TestStatus.FAILED
-            _, _, trace_back = sys.exc_info()
-            traceback.print_tb(trace_back) # Fixed format
-            tb_info = traceback.extract_tb(trace_back)
-            _, line, _, text = tb_info[-1]
-            test_def.comments = test_def.comments + 'Key error on line {} in statement {}'.format(line, text)
+    async def execute_test_async(self, test_def: TestDefinition) -> TestDefinition:
+        ''' The same as execute_test but for tests written as async def methods. The test is awaited on the event loop of the worker. '''
+        start_time = datetime.now()
+        init_test_class = None
+        try:
+            test_def = self.pre_test_setup(test_def)
+            if test_def.test_status == TestStatus.BLOCKED:
+                return self.update_test_definition(test_def, start_time)
 
-            return self.update_test_definition(test_def, start_time)
+            init_test_class, test_func = self.load_test(test_def)
 
-        except Exception as err:
-            test_def.test_status = TestStatus.FAILED
-            test_def.comments = test_def.comments + str(err)
+            test_timeout = self.get_test_timeout(WorkerCache.suite_records[SuiteRecord.key_for(test_def.test_pack, test_def.test_suite)])
+            await asyncio.wait_for(test_func(init_test_class), test_timeout)
 
-            _, _, trace_back = sys.exc_info()
-            traceback.print_tb(trace_back) # Fixed format
-            tb_info = traceback.extract_tb(trace_back)
-            _, line, _, text = tb_info[-1]
-            test_def.comments = test_def.comments + 'Unhandled error on line {} in statement {}'.format(line, text)
+            test_def.test_status = TestStatus.PASSED
+            return self.update_test_definition(test_def, start_time)
 
+        except Exception as err:
+            self.fail_test(test_def, err)
             return self.update_test_definition(test_def, start_time)
 
         finally:
+            self.post_test_cleanup(test_def, init_test_class)
+
+
+    async def execute_tests_async(self, test_defs: List[TestDefinition]) -> List[TestDefinition]:
+        ''' Executes the async tests passed in all at once on the running event loop, at most async concurrency of them at the same time. '''
+        semaphore = asyncio.Semaphore(self.trav_con.async_concurrency)
+
+        async def execute_limited(test_def: TestDefinition):
+            async with semaphore:
+                return await self.execute_test_async(test_def)
+
+        return await asyncio.gather(*[execute_limited(test_def) for test_def in test_defs])
+
+
+    def load_test(self, test_def: TestDefinition):
+        ''' Returns the initialised test class and the test function of the test definition passed in. '''
+        # Get the test class out of the test module .py file, the worker cache only imports it once
+        test_class = WorkerCache.get_test_class(test_def.test_pack, test_def.test_suite)
+        # Run the suite setup hook the first time this worker gets a test of the suite, the tests share what it returns
+        WorkerCache.get_suite_fixture(test_def.test_pack, test_def.test_suite)
+        # Initialise and store in a var the test class, not forgetting to pass it the required arguments
+        init_test_class = test_class(self.trav_con, test_def)
+        # Get the function under test to execute - Its the raw function, this doesnt execute it, only loads its definition into mem
+        test_func = getattr(test_class, test_def.test_name)
+
+        return init_test_class, test_func
+
+
+    def is_async_test(self, test_def: TestDefinition):
+        '''
+            Returns True if the test method of the test definition is an async def method. The async tests of a suite come from
+            discovery, the suite is only imported if discovery did not look at it. That is remembered in the suite record, so a suite
+            is imported at most once, even if the import fails.
+        '''
+        suite_record = test_def.suite_record
+        if suite_record.async_tests is None:
             try:
-                try:
-                    if test_def.test_status == TestStatus.FAILED:
-                        screenshot = pyautogui.screenshot()
+                test_class = WorkerCache.get_test_class(test_def.test_pack, test_def.test_suite)
+                suite_record.async_tests = [name for name in dir(test_class) if inspect.iscoroutinefunction(getattr(test_class, name))]
+            except Exception: # If the suite can't be loaded, run its tests the normal way and let them report the error.
+                suite_record.async_tests = []
 
-                        if platform.system() == 'Windows':
-                            save_path = f'{test_def.screenshot_dir}\\{test_def.test_name}_error.png'
-                        else:
-                            save_path = f'{test_def.screenshot_dir}/{test_def.test_name}_error.png'
+        return test_def.test_name in suite_record.async_tests
 
-                        screenshot.save(save_path)
-                except OSError:
-                    pass
 
-                # Try clean up driver, if this works then there was a driver, if not then driver probably not used in the test.
-                init_test_class.driver.quit_the_driver()
-            except (UnboundLocalError, AttributeError):
-                pass
+    def fail_test(self, test_def: TestDefinition, err: Exception):
+        ''' Marks the test as failed and adds a comment describing the error passed in. '''
+        test_def.test_status = TestStatus.FAILED
+        trace_back = err.__traceback__
+
+        if isinstance(err, (TimeoutError, asyncio.TimeoutError)):
+            test_def.comments = test_def.comments + 'Timeout Error'
+            return
+
+        traceback.print_tb(trace_back) # Fixed format
+        tb_info = traceback.extract_tb(trace_back)
+        _, line, _, text = tb_info[-1]
+
+        if isinstance(err, AssertionError):
+            test_def.comments = test_def.comments + 'Assertion error on line {} in statement {}'.format(line, text)
+        elif isinstance(err, TypeError):
+            test_def.comments = test_def.comments + 'Type error on line {} in statement {}'.format(line, text)
+        elif isinstance(err, KeyError):
+            test_def.comments = test_def.comments + 'Key error on line {} in statement {}'.format(line, text)
+        else:
+            test_def.comments = test_def.comments + str(err)
+            test_def.comments = test_def.comments + 'Unhandled error on line {} in statement {}'.format(line, text)
+
+
+    def block_test(self, test_def: TestDefinition, dependency: TestDefinition):
+        ''' Marks the test as blocked because the test passed in, which it depends on, did not pass. The test is not executed. '''
+        test_def.test_status = TestStatus.BLOCKED
+        test_def.test_start_time = datetime.now()
+        test_def.test_end_time = test_def.test_start_time
+        test_def.comments = test_def.comments + f'Blocked, the test it depends on, {dependency.test_name} ' \
+                            f'({dependency.test_config_title}:{dependency.test_config_value}), did not pass.'
 
 
     def update_test_definition(self, test_def: TestDefinition, start_time):
@@ -194,5 +631,27 @@ class Executor:
         return test_def
 
 
-    def post_test_cleanup(self):
+    def post_test_cleanup(self, test_def: TestDefinition, init_test_class):
         ''' This method will be executed after every test to ensure standard clean up operations are conducted. '''
+        # The browser of a failed test takes a screenshot, it is written on the background thread of the worker's screenshot writer so
+        # the worker can move on to the next test right away. Tests without a driver have nothing to take a screenshot of.
+        try:
+            if test_def.test_status == TestStatus.FAILED:
+                screenshot = init_test_class.driver.get_screenshot_png()
+
+                if screenshot is not None:
+                    if platform.system() == 'Windows':
+                        save_path = f'{test_def.screenshot_dir}\\{test_def.test_name}_error'
+                    else:
+                        save_path = f'{test_def.screenshot_dir}/{test_def.test_name}_error'
+
+                    WorkerCache.screenshot_writer.save(screenshot, save_path)
+        except AttributeError:
+            pass
+
+        # Try hand the driver back to the session pool, if this works then there was a driver, if not then driver probably not
+        # used in the test. A browser which was used by a failed test is not reused.
+        try:
+            init_test_class.driver.release_the_driver(recycle=test_def.test_status == TestStatus.FAILED)
+        except AttributeError:
+            pass
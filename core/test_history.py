@@ -0,0 +1,167 @@
+''' The test history module keeps track of results from previous test runs. It is used to plan a test run, for example to start
+    the tests which take the longest first or to skip tests which did not change. The history is stored as a json file in the history folder. '''
+import os
+import json
+import platform
+from statistics             import mean
+from typing                 import Dict, List
+from core.core_models       import TestDefinition, TraverseConfig, TestStatus, SuiteRecord
+from utilities.json_helper  import LoadJson
+
+
+class TestHistory:
+    ''' Loads, updates and saves the history of tests. Every test is keyed by its pack, suite, name, capability and test config. '''
+    DEFAULT_DURATION = 1.0 # Seconds, used when there is no history at all to estimate from
+    DURATION_WEIGHT = 0.5 # How much the latest duration counts towards the expected duration of a test
+    FLAKINESS_WINDOW = 20 # The number of latest attempts of a test its flakiness score is based on
+
+    def __init__(self, traverse_config: TraverseConfig):
+        self.trav_con = traverse_config
+
+        if platform.system() == 'Windows':
+            self.history_file = f'{self.trav_con.history_folder}\\test_history.json'
+        else:
+            self.history_file = f'{self.trav_con.history_folder}/test_history.json'
+
+        self.history = {'durations': {}, 'lastResults': {}, 'attempts': {}}
+        if os.path.exists(self.history_file):
+            try:
+                self.history.update(LoadJson.using_filepath(self.history_file))
+            except json.JSONDecodeError: # A broken history file is not worth failing a test run over, start again.
+                pass
+
+        self.durations: Dict[str, float] = self.history['durations']
+        self.last_results: Dict[str, Dict] = self.history['lastResults']
+        self.attempts: Dict[str, str] = self.history['attempts'] # P for a passed attempt, F for a failed one, oldest first
+
+
+    @staticmethod
+    def key_for(test_def: TestDefinition):
+        ''' Returns the key a test is stored under in the history. '''
+        return f'{test_def.test_pack}/{test_def.test_suite}/{test_def.test_name}/{test_def.capability}/' \
+               f'{test_def.test_config_title}:{test_def.test_config_value}'
+
+
+    def record_result(self, test_def: TestDefinition):
+        '''
+            Adds the result of a finished test to the history. Call save to write the history to disk. The last result is kept with
+            the hash of the test's inputs, so a later run can tell whether the test needs to run again.
+        '''
+        history_key = self.key_for(test_def)
+        self.last_results[history_key] = {
+            'inputsHash': test_def.inputs_hash,
+            'testStatus': test_def.test_status,
+            'testStartTime': test_def.test_start_time.isoformat() if test_def.test_start_time else None,
+            'testEndTime': test_def.test_end_time.isoformat() if test_def.test_end_time else None,
+            'comments': test_def.comments
+        }
+
+        if test_def.test_status == TestStatus.BLOCKED or test_def.test_start_time is None or test_def.test_end_time is None:
+            return
+
+        duration = (test_def.test_end_time - test_def.test_start_time).total_seconds()
+
+        if history_key in self.durations:
+            self.durations[history_key] = self.DURATION_WEIGHT * duration + (1 - self.DURATION_WEIGHT) * self.durations[history_key]
+        else:
+            self.durations[history_key] = duration
+
+
+    def get_expected_durations(self, test_defs: List[TestDefinition]) -> Dict[int, float]:
+        '''
+            Returns the expected duration in seconds of each test definition passed in, keyed by test id. Tests without history get
+            the average duration of their test suite, or if the suite has no history either, the average of all tests in the history.
+        '''
+        suite_durations = {}
+        for history_key, duration in self.durations.items():
+            test_pack, test_suite, _ = history_key.split('/', 2)
+            suite_durations.setdefault(SuiteRecord.key_for(test_pack, test_suite), []).append(duration)
+
+        if len(self.durations) > 0:
+            default_duration = mean(self.durations.values())
+        else:
+            default_duration = self.DEFAULT_DURATION
+
+        expected_durations = {}
+        for test_def in test_defs:
+            history_key = self.key_for(test_def)
+            if history_key in self.durations:
+                expected_durations[test_def.test_id] = self.durations[history_key]
+            else:
+                suite_history = suite_durations.get(SuiteRecord.key_for(test_def.test_pack, test_def.test_suite))
+                expected_durations[test_def.test_id] = mean(suite_history) if suite_history else default_duration
+
+        return expected_durations
+
+
+    def get_expected_test_durations(self, tests_list: List) -> Dict[str, float]:
+        '''
+            Returns the expected duration in seconds of each [test pack, test suite, test case] passed in, keyed by pack/suite/case. That
+            is the average over every capability and test config it ran with. Tests without history are estimated like they are in
+            get_expected_durations.
+        '''
+        test_durations = {}
+        suite_durations = {}
+        for history_key, duration in self.durations.items():
+            test_pack, test_suite, test_name, _ = history_key.split('/', 3)
+            test_durations.setdefault(f'{test_pack}/{test_suite}/{test_name}', []).append(duration)
+            suite_durations.setdefault(SuiteRecord.key_for(test_pack, test_suite), []).append(duration)
+
+        if len(self.durations) > 0:
+            default_duration = mean(self.durations.values())
+        else:
+            default_duration = self.DEFAULT_DURATION
+
+        expected_durations = {}
+        for test_item in tests_list:
+            test_key = '/'.join(test_item)
+            if test_key in test_durations:
+                expected_durations[test_key] = mean(test_durations[test_key])
+            else:
+                suite_history = suite_durations.get(SuiteRecord.key_for(test_item[0], test_item[1]))
+                expected_durations[test_key] = mean(suite_history) if suite_history else default_duration
+
+        return expected_durations
+
+
+    def record_attempt(self, test_def: TestDefinition):
+        '''
+            Adds an attempt of a test to its pass/fail history, retries included. Only passed and failed attempts count, a test which
+            was blocked says nothing about whether it is flaky. A test which timed out counts as failed, it comes back failed.
+        '''
+        if test_def.test_status not in (TestStatus.PASSED, TestStatus.FAILED):
+            return
+
+        history_key = self.key_for(test_def)
+        attempt = 'P' if test_def.test_status == TestStatus.PASSED else 'F'
+        self.attempts[history_key] = (self.attempts.get(history_key, '') + attempt)[-self.FLAKINESS_WINDOW:]
+
+
+    def get_flakiness_score(self, test_def: TestDefinition, min_attempts) -> float:
+        '''
+            Returns the flakiness score of the test passed in, the share of its latest attempts which flipped between passed and
+            failed. A test which always passes or always fails scores 0, one which flips every attempt scores 1. None is returned if
+            the test has fewer attempts than the min attempts passed in.
+        '''
+        attempts = self.attempts.get(self.key_for(test_def), '')
+        if len(attempts) < max(min_attempts, 2):
+            return None
+
+        flips = sum(attempts[i] != attempts[i +1] for i in range(len(attempts) -1))
+        return flips / (len(attempts) -1)
+
+
+    def get_last_result(self, test_def: TestDefinition) -> Dict:
+        ''' Returns the last recorded result of the test passed in, or None if it has never been recorded. '''
+        return self.last_results.get(self.key_for(test_def))
+
+
+    def save(self):
+        ''' Writes the history to disk. The file is replaced in one go so a crash can not leave half a history file behind. '''
+        os.makedirs(self.trav_con.history_folder, exist_ok=True)
+        temp_file = f'{self.history_file}.tmp'
+
+        with open(temp_file, 'w') as file_out:
+            json.dump(self.history, file_out, indent=4)
+
+        os.replace(temp_file, self.history_file)
@@ -0,0 +1,91 @@
+''' The results journal keeps the result of every finished test on disk while a test run is still busy. If the run crashes or is
+    cancelled, the results so far are not lost and the run can be resumed with only the tests which did not finish yet. '''
+import os
+import json
+from typing                 import List
+from core.core_models       import TestDefinition
+from core.test_history      import TestHistory
+
+JOURNAL_FILE_NAME = 'results_journal.jsonl'
+
+
+class ResultsJournal:
+    '''
+        Appends the result of every finished test to a journal file in the test run result directory, one json line per test. Every
+        line is flushed to disk when it is written, so the journal holds everything that finished before a crash.
+    '''
+    def __init__(self, testrun_result_dir):
+        self.journal_file = os.path.join(testrun_result_dir, JOURNAL_FILE_NAME)
+        self.file_out = None
+
+
+    def record_result(self, test_def: TestDefinition):
+        ''' Appends the finished test definition to the journal. The journal file is only created when the first result comes in. '''
+        if self.file_out is None:
+            os.makedirs(os.path.dirname(self.journal_file), exist_ok=True)
+            self.file_out = open(self.journal_file, 'a', encoding='utf-8')
+
+            # A resumed run may find a line the crash cut short, start on a new line so the next result is not lost with it
+            if self.file_out.tell() > 0:
+                with open(self.journal_file, 'rb') as f_in:
+                    f_in.seek(-1, os.SEEK_END)
+                    if f_in.read(1) != b'\n':
+                        self.file_out.write('\n')
+
+        self.file_out.write(json.dumps(test_def.to_dict()) + '\n')
+        self.file_out.flush()
+        os.fsync(self.file_out.fileno())
+
+
+    def close(self):
+        ''' Closes the journal file. '''
+        if self.file_out is not None:
+            self.file_out.close()
+            self.file_out = None
+
+
+    @staticmethod
+    def load_results(testrun_result_dir) -> List[TestDefinition]:
+        '''
+            Loads the finished tests from the journal in the test run result directory passed in. A line which was only half written
+            when the run stopped is skipped, that test simply runs again.
+        '''
+        journal_file = os.path.join(testrun_result_dir, JOURNAL_FILE_NAME)
+        if not os.path.exists(journal_file):
+            raise Exception(f'There is no results journal to resume from in {testrun_result_dir}')
+
+        journal_results = []
+        with open(journal_file, 'r', encoding='utf-8') as f_in:
+            for line in f_in:
+                try:
+                    journal_results.append(TestDefinition.from_dict(json.loads(line)))
+                except (json.JSONDecodeError, KeyError):
+                    pass
+
+        return journal_results
+
+
+    @staticmethod
+    def get_remaining_tests(cartesian: List[TestDefinition], journal_results: List[TestDefinition]):
+        '''
+            Splits the cartesian product into the tests which still have to run and the tests which already finished according to the
+            journal results passed in. Returns both lists, the finished tests hold the result from the journal.
+        '''
+        finished_results = {TestHistory.key_for(test_def): test_def for test_def in journal_results}
+        remaining_tests = []
+        finished_tests = []
+
+        for test_def in cartesian:
+            journal_result = finished_results.get(TestHistory.key_for(test_def))
+            if journal_result is None:
+                remaining_tests.append(test_def)
+                continue
+
+            test_def.test_status = journal_result.test_status
+            test_def.test_start_time = journal_result.test_start_time
+            test_def.test_end_time = journal_result.test_end_time
+            test_def.test_attempts = journal_result.test_attempts
+            test_def.comments = journal_result.comments
+            finished_tests.append(test_def)
+
+        return remaining_tests, finished_tests
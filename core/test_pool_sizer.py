@@ -0,0 +1,60 @@
+''' The pool sizer decides how many workers the executor should use while a test run is busy. It samples the load of the machine and
+    grows the pool while there is room, or shrinks it when browsers push the machine too hard. '''
+import os
+import time
+
+import psutil
+
+from core.core_models       import TraverseConfig
+from core.test_logger       import Logger
+
+
+class PoolSizer:
+    '''
+        Grows or shrinks the worker pool one worker at a time, between the min and max workers of the adaptive workers config. The
+        pool shrinks when the cpu, memory or load average of the machine is over its max, and grows when all of them are comfortably
+        under it and there is work waiting. Every resize is logged on the debug level, with the samples it was based on.
+    '''
+    HEADROOM = 0.75 # The pool only grows while every sample is under this share of its max
+
+    def __init__(self, traverse_config: TraverseConfig):
+        self.trav_con = traverse_config
+        self.logger = Logger(traverse_config)
+        self.next_sample_at = time.monotonic() + traverse_config.sizing_interval
+        psutil.cpu_percent(interval=None) # The first call only starts the measurement
+
+
+    def get_initial_size(self):
+        ''' Returns the number of workers to start with, parallel tests + 1 kept between the min and max workers. '''
+        return min(max(self.trav_con.parallel_tests +1, self.trav_con.min_workers), self.trav_con.max_workers)
+
+
+    def get_pool_size(self, pool_size, waiting_work):
+        '''
+            Returns the number of workers the pool should have, pass in its current size and the number of work items waiting in the
+            queue. The machine is only sampled once per sample interval, in between the current size is returned.
+        '''
+        if time.monotonic() < self.next_sample_at:
+            return pool_size
+        self.next_sample_at = time.monotonic() + self.trav_con.sizing_interval
+
+        cpu_percent = psutil.cpu_percent(interval=None)
+        memory_percent = psutil.virtual_memory().percent
+        load_per_cpu = psutil.getloadavg()[0] / (os.cpu_count() or 1)
+        samples = f'cpu {cpu_percent:.0f}%, memory {memory_percent:.0f}%, load {load_per_cpu:.2f} per cpu, {waiting_work} work items waiting'
+
+        overloaded = cpu_percent > self.trav_con.max_cpu_percent or memory_percent > self.trav_con.max_memory_percent \
+                     or load_per_cpu > self.trav_con.max_load_per_cpu
+        has_room = cpu_percent < self.trav_con.max_cpu_percent * self.HEADROOM \
+                   and memory_percent < self.trav_con.max_memory_percent * self.HEADROOM \
+                   and load_per_cpu < self.trav_con.max_load_per_cpu * self.HEADROOM
+
+        if overloaded and pool_size > self.trav_con.min_workers:
+            self.logger.debug(f'Shrinking the worker pool from {pool_size} to {pool_size - 1} workers, {samples}.')
+            return pool_size - 1
+
+        if has_room and waiting_work > 0 and pool_size < self.trav_con.max_workers:
+            self.logger.debug(f'Growing the worker pool from {pool_size} to {pool_size + 1} workers, {samples}.')
+            return pool_size + 1
+
+        return pool_size
@@ -2,31 +2,77 @@
 from json import JSONDecodeError
 import platform
 import os
+import re
 import sys
+import zlib
+import hashlib
+import inspect
 import importlib
-from typing                 import List
-from core.core_models       import TestDefinition, TraverseConfig
+from datetime               import datetime
+from typing                 import Dict, List
+from core.core_models       import TestDefinition, TraverseConfig, TestStatus, SuiteHooks, SuiteRecord
+from core.test_history      import TestHistory
+from core.test_discovery    import DiscoveryIndex, DiscoveryBackend, SuiteParser
+from core.test_selection    import TagIndex
 from utilities.json_helper  import LoadJson
 
 
 class Profiler:
     ''' The Profiler will be responsible for loadings and preparing the queue of tests, along with any global preliminary
         checks or setup's required. '''
+    # Picks the hook file name out of a line like: self.driver = DriverActions(self.test_def, 'swaglabs')
+    HOOK_FILE_PATTERN = re.compile(r'''DriverActions\(\s*[^,()]+,\s*['"]([^'"]+)['"]''')
+
     def __init__(self, traverse_config: TraverseConfig):
         self.trav_con = traverse_config
+        self.file_hashes = {}
+        self.inputs_hashes = {}
+        self.discovery_index = DiscoveryIndex(traverse_config) if traverse_config.discovery_index is True else None
+        self.suite_records: Dict[str, SuiteRecord] = {} # The suite json of every suite is loaded once, see get_suite_record
+        self.suite_test_cases: Dict[tuple, Dict[str, Dict]] = {} # (test pack, test suite) -> test cases, see _get_test_cases
 
 
     def _get_all_test_cases_in_test_suite(self, test_pack, test_suite_name):
         ''' This returns all test cases in a test suite given the name of the test pack and test suite passed in. '''
-        tests_list = []
-        module = importlib.import_module(f"{test_pack}.{test_suite_name}")
-        test_class = getattr(module, 'Tests')
-        test_cases = [func for func in dir(test_class) if callable(getattr(test_class, func)) and not func.startswith('_')]
+        return [[test_pack, test_suite_name, test_case] for test_case in self._get_test_cases(test_pack, test_suite_name)]
 
-        for test_case in test_cases:
-            tests_list.append([test_pack, test_suite_name, test_case])
 
-        return tests_list
+    def _get_test_cases(self, test_pack, test_suite_name) -> Dict[str, Dict]:
+        '''
+            Returns the test cases of the test suite passed in, each with its tags and whether it is async, like {"login": {"tags":
+            ["smoke"], "isAsync": false}}. The test cases of a suite which did
+            not change since it was last scanned come from the discovery index. Otherwise the suite file is parsed, it is only
+            imported if its test cases can not be told from the file alone or the discovery backend is set to import.
+        '''
+        if (test_pack, test_suite_name) in self.suite_test_cases:
+            return self.suite_test_cases[(test_pack, test_suite_name)]
+
+        suite_file = os.path.join(self.trav_con.tests_folder, test_pack, f'{test_suite_name}.py')
+        use_index = self.discovery_index is not None and os.path.exists(suite_file)
+        test_cases = None
+        if use_index:
+            test_cases = self.discovery_index.get_test_cases(suite_file)
+
+        if test_cases is None:
+            if self.trav_con.test_discovery == DiscoveryBackend.AST:
+                test_cases = SuiteParser.get_test_cases(suite_file)
+            if test_cases is None:
+                test_cases = self._import_test_cases(test_pack, test_suite_name)
+            if use_index:
+                self.discovery_index.set_test_cases(suite_file, test_cases)
+
+        self.suite_test_cases[(test_pack, test_suite_name)] = test_cases
+        return test_cases
+
+
+    def _import_test_cases(self, test_pack, test_suite_name) -> Dict[str, Dict]:
+        ''' Imports the test suite passed in and returns its test cases, see _get_test_cases. '''
+        module = importlib.import_module(f"{test_pack}.{test_suite_name}")
+        test_class = getattr(module, 'Tests')
+        suite_hooks = (SuiteHooks.SETUP, SuiteHooks.TEARDOWN)
+        return {func: {'tags': list(getattr(getattr(test_class, func), 'test_tags', [])),
+                       'isAsync': inspect.iscoroutinefunction(getattr(test_class, func))}
+                for func in dir(test_class) if callable(getattr(test_class, func)) and not func.startswith('_') and func not in suite_hooks}
 
 
     def _get_all_test_packs(self, tests_dir:str):
@@ -49,19 +95,61 @@ class Profiler:
             return [file for file in os.listdir(f'{tests_dir}/{test_pack_name}') if '.py' in file and '__' not in file]
 
 
-    def run_profiler(self):
+    def run_profiler(self, lazy=False):
         ''' This is the entry and exit point for the profiler, this is the method you call to use the profiler, all other
-            methods are just helper methods '''
+            methods are just helper methods. Pass in lazy as True to get the cartesian product as a generator, the tests are then
+            only created while the executor takes them. A test run where tests depend on each other is always returned as a list,
+            the dependencies are linked over the whole run. '''
 
-        # Prepare the cartesian product for all the tests
-        cartesian = self.get_cartesian_of_tests()
+        # Prepare the tests of the test run and the suites they are in, every suite json is only loaded once
+        tests_list = self.get_tests_of_test_run()
+        for test_item in tests_list:
+            self.get_suite_record(test_item[0], test_item[1])
+
+        if self.discovery_index is not None:
+            self.discovery_index.save()
 
         # Run Global Setup
         self.global_setup()
 
+        if lazy is True and not self.has_test_dependencies():
+            # The executor only schedules by duration within a batch of a lazy cartesian product, so the longest tests are created first
+            if self.trav_con.schedule_by_duration is True:
+                tests_list = self.get_tests_by_duration(tests_list)
+            return self.iter_profiled_tests(tests_list)
+
+        # Prepare the cartesian product for all the tests
+        cartesian = list(self.iter_profiled_tests(tests_list))
+
+        # Link the tests which must wait for other tests, declared with testDependencies in the suite json
+        self.set_test_dependencies(cartesian)
+
         return cartesian
 
 
+    def get_tests_by_duration(self, tests_list: List) -> List:
+        ''' Returns the tests list passed in with the tests expected to take the longest (going by the test history) first. '''
+        test_history = TestHistory(self.trav_con)
+        if len(test_history.durations) == 0:
+            return tests_list
+
+        expected_durations = test_history.get_expected_test_durations(tests_list)
+        return sorted(tests_list, key=lambda test_item: expected_durations['/'.join(test_item)], reverse=True)
+
+
+    def iter_profiled_tests(self, tests_list: List):
+        ''' Yields the test definitions of the cartesian product, each with the hash of what it depends on (see get_inputs_hash). '''
+        for test_def in self.iter_cartesian_of_tests(tests_list):
+            # Keep track of what every test depends on, so later runs can tell if it changed
+            test_def.inputs_hash = self.get_inputs_hash(test_def)
+            yield test_def
+
+
+    def has_test_dependencies(self):
+        ''' Returns True if a suite of the test run declares testDependencies in its suite json. '''
+        return any(len(suite_record.tests_json.get('testDependencies', {})) > 0 for suite_record in self.suite_records.values())
+
+
     def get_tests_list(self, trav_con:TraverseConfig, test:List):
         '''
             This method handles determining the * logic in a test. A test is reference to a test pack - test suite - test case
@@ -110,107 +198,341 @@ class Profiler:
         return tests_list
 
 
+    def get_tests_of_test_run(self) -> List:
+        ''' Returns the [test pack, test suite, test case] of every test in the test run, with the * symbols worked out. '''
+        if self.trav_con.tests_folder not in sys.path:
+            sys.path.append(f'{self.trav_con.tests_folder}')
+        tests_list = []
+
+        # Process the tests in the test run. Needed to handle the * symbols.
+        for test in self.trav_con.tests:
+            tests_list.extend(self.get_tests_list(self.trav_con, test))
+
+        if self.trav_con.tag_expression:
+            tests_list = self.select_tests_by_tags(tests_list, self.trav_con.tag_expression)
+
+        return tests_list
+
+
+    def select_tests_by_tags(self, tests_list: List, tag_expression: str) -> List:
+        '''
+            Returns the tests of the tests list passed in which match the tag expression, like "smoke and not slow". The tags of a
+            test are the ones on its test method plus the "tags" and "testTags" of its suite json. Tags come from the discovery index
+            and the suite json only, so suites without a matching test are never imported or added to the suite records.
+        '''
+        tag_index = TagIndex()
+        suite_tags = {}
+        for test_item in tests_list:
+            suite_key = (test_item[0], test_item[1])
+            if suite_key not in suite_tags:
+                tests_json = self._load_suite_json(test_item[0], test_item[1])
+                suite_tags[suite_key] = (tests_json.get('tags', []), tests_json.get('testTags', {}))
+
+            test_tags = list(self._get_test_cases(test_item[0], test_item[1]).get(test_item[2], {}).get('tags', []))
+            test_tags.extend(suite_tags[suite_key][0])
+            test_tags.extend(suite_tags[suite_key][1].get(test_item[2], []))
+            tag_index.add_test(test_item, test_tags)
+
+        return tag_index.select(tag_expression)
+
+
+    def _load_suite_json(self, test_pack, test_suite) -> Dict:
+        ''' Returns the suite json of the test suite passed in, or an empty dict if the suite has none. '''
+        if platform.system() == 'Windows':
+            test_config_path = f'{self.trav_con.tests_folder}\\{test_pack}\\{test_suite}.json'
+        else:
+            test_config_path = f'{self.trav_con.tests_folder}/{test_pack}/{test_suite}.json'
+
+        if not os.path.exists(test_config_path):
+            return {}
+
+        try:
+            return LoadJson.using_filepath(test_config_path)
+        except JSONDecodeError:
+            raise Exception(f'Error loading the test json file: {test_config_path}. Double check the integrity of this file.')
+
+
+    def get_suite_record(self, test_pack, test_suite) -> SuiteRecord:
+        '''
+            Returns the suite record of the test suite passed in, with its suite json loaded and the async tests discovery found in it.
+            The suite json is only loaded the first time, every test and capability of the suite shares the same suite record after that.
+        '''
+        suite_key = SuiteRecord.key_for(test_pack, test_suite)
+        if suite_key in self.suite_records:
+            return self.suite_records[suite_key]
+
+        if platform.system() == 'Windows':
+            screenshot_dir = f'{self.trav_con.testrun_result_dir}\\{test_pack}\\{test_suite}'
+        else:
+            screenshot_dir = f'{self.trav_con.testrun_result_dir}/{test_pack}/{test_suite}'
+
+        test_config_json = self._load_suite_json(test_pack, test_suite)
+
+        # The executor batches async tests together, discovery tells which ones they are without the executor importing the suite
+        try:
+            async_tests = [test_name for test_name, test_case in self._get_test_cases(test_pack, test_suite).items() if test_case['isAsync']]
+        except Exception: # A suite which can not be imported fails its tests when they run, like it did before discovery
+            async_tests = None
+
+        self.suite_records[suite_key] = SuiteRecord(test_pack, test_suite, test_config_json, test_config_json.get('productionSafe', False),
+                                                    screenshot_dir, async_tests)
+        return self.suite_records[suite_key]
+
+
     def get_cartesian_of_tests(self):
         '''
             This returns a list of test definitions to be executed. The list is a cartesian product of all applicable
             tests + capabilities + test configs
         '''
-        sys.path.append(f'{self.trav_con.tests_folder}')
-        test_definitions_list = []
-        tests_list = []
+        return list(self.iter_cartesian_of_tests(self.get_tests_of_test_run()))
 
-        # Process the tests in the test run. Needed to handle the * symbols.
-        for test in self.trav_con.tests:
-            tests_list.extend(self.get_tests_list(self.trav_con, test))
 
+    def iter_cartesian_of_tests(self, tests_list: List):
+        '''
+            Yields the test definitions of the cartesian product of the tests list passed in + capabilities + test configs, one at a
+            time. Nothing is created before it is asked for, so a very large product does not have to fit in memory at once.
+        '''
         if self.trav_con.capabilities is None or len(self.trav_con.capabilities) < 1:
             self.trav_con.capabilities = [' - ']
 
         for capability in self.trav_con.capabilities:
             for test_item in tests_list:
-                production_safe = False
+                suite_record = self.get_suite_record(test_item[0], test_item[1])
 
-                if platform.system() == 'Windows':
-                    test_config_path = f'{self.trav_con.tests_folder}\\{test_item[0]}\\{test_item[1]}.json'
-                    screenshot_dir = f'{self.trav_con.testrun_result_dir}\\{test_item[0]}\\{test_item[1]}'
-                else:
-                    test_config_path = f'{self.trav_con.tests_folder}/{test_item[0]}/{test_item[1]}.json'
-                    screenshot_dir = f'{self.trav_con.testrun_result_dir}/{test_item[0]}/{test_item[1]}'
-
-                if os.path.exists(test_config_path):
-                    try:
-                        test_config_json = LoadJson.using_filepath(test_config_path)
-                    except JSONDecodeError:
-                        raise Exception(f'Error loading the test json file: {test_config_path}. Double check the integrity of this file.')
-
-                    ## Attempt to load json values from test config(json) file
-                    try:
-                        test_configs = test_config_json['testConfigurations']
-                    except KeyError:
-                        test_configs = {}
-                    try:
-                        excluded_environments = test_config_json['excludedEnvironments']
-                    except KeyError:
-                        excluded_environments = []
-                    try:
-                        production_safe = test_config_json['productionSafe']
-                    except KeyError:
-                        pass
-
-                    if self.trav_con.environment in excluded_environments:
-                        continue
-
-                    if len(test_configs.items()) > 0:
-                        for key, values in test_configs.items():
-                            for value in values:
-                                test_definition = TestDefinition()
-
-                                test_definition.test_pack = test_item[0]
-                                test_definition.test_suite = test_item[1]
-                                test_definition.test_name = test_item[2]
-                                test_definition.platform = self.trav_con.platform
-                                test_definition.capability = capability
-                                test_definition.test_config_title = str(key)
-                                test_definition.test_config_value = str(value)
-                                test_definition.production_safe = production_safe
-                                test_definition.tests_json = test_config_json
-                                test_definition.screenshot_dir = screenshot_dir
-
-                                test_definitions_list.append(test_definition)
-
-                    else:
-                        test_definition = TestDefinition()
-
-                        test_definition.test_pack = test_item[0]
-                        test_definition.test_suite = test_item[1]
-                        test_definition.test_name = test_item[2]
-                        test_definition.platform = self.trav_con.platform
-                        test_definition.capability = capability
-                        test_definition.test_config_title = ' - '
-                        test_definition.test_config_value = ' - '
-                        test_definition.production_safe = production_safe
-                        test_definition.tests_json = test_config_json
-                        test_definition.screenshot_dir = screenshot_dir
-
-                        test_definitions_list.append(test_definition)
+                if self.trav_con.environment in suite_record.tests_json.get('excludedEnvironments', []):
+                    continue
 
+                ## Suites without test configs run once, with - as their test config
+                test_configs = suite_record.tests_json.get('testConfigurations', {})
+                if len(test_configs.items()) > 0:
+                    config_values = [(str(key), str(value)) for key, values in test_configs.items() for value in values]
                 else:
-                    test_definition = TestDefinition()
+                    config_values = [(' - ', ' - ')]
+
+                for test_config_title, test_config_value in config_values:
+                    # The tests of a suite share its suite record, for the test pack, suite, tests json and so on
+                    test_definition = TestDefinition(suite_record)
 
-                    test_definition.test_pack = test_item[0]
-                    test_definition.test_suite = test_item[1]
                     test_definition.test_name = test_item[2]
                     test_definition.platform = self.trav_con.platform
                     test_definition.capability = capability
-                    test_definition.test_config_title = ' - '
-                    test_definition.test_config_value = ' - '
-                    test_definition.production_safe = production_safe
-                    test_definition.tests_json = {}
-                    test_definition.screenshot_dir = screenshot_dir
+                    test_definition.test_config_title = test_config_title
+                    test_definition.test_config_value = test_config_value
+                    test_definition.intern_strings()
+
+                    yield test_definition
+
+
+    def _get_file_hash(self, file_path):
+        ''' Returns the sha256 of the file passed in, or an empty string if it does not exist. Each file is only read once. '''
+        if file_path not in self.file_hashes:
+            if os.path.exists(file_path):
+                with open(file_path, 'rb') as open_file:
+                    self.file_hashes[file_path] = hashlib.sha256(open_file.read()).hexdigest()
+            else:
+                self.file_hashes[file_path] = ''
+
+        return self.file_hashes[file_path]
+
+
+    def get_inputs_hash(self, test_def: TestDefinition):
+        '''
+            Returns a hash of the files the test depends on. That is the test suite .py and .json files, the hook files the suite uses
+            and the capability json of the test. If the hash is the same as last run, nothing the test depends on changed.
+        '''
+        inputs_key = (test_def.test_pack, test_def.test_suite, test_def.capability)
+        if inputs_key in self.inputs_hashes:
+            return self.inputs_hashes[inputs_key]
+
+        root_dir = self.trav_con.root_directory
+        driver_config = LoadJson.using_filepath_cached(os.path.join(root_dir, 'driver', 'driver_config.json'))
+        suite_path = os.path.join(self.trav_con.tests_folder, test_def.test_pack, test_def.test_suite)
+        input_files = [f'{suite_path}.py', f'{suite_path}.json']
+
+        if os.path.exists(f'{suite_path}.py'):
+            with open(f'{suite_path}.py', 'r', encoding='utf-8') as open_file:
+                for hook_file_name in self.HOOK_FILE_PATTERN.findall(open_file.read()):
+                    input_files.append(os.path.join(root_dir, 'driver', 'hooks', f'{hook_file_name}.json'))
+
+        input_files.append(os.path.join(root_dir, 'driver', driver_config['capabilityDir'], str(test_def.platform), f'{test_def.capability}.json'))
+
+        inputs_hash = hashlib.sha256()
+        for input_file in input_files:
+            inputs_hash.update(f'{os.path.basename(input_file)}:{self._get_file_hash(input_file)};'.encode('utf-8'))
+
+        self.inputs_hashes[inputs_key] = inputs_hash.hexdigest()
+        return self.inputs_hashes[inputs_key]
 
-                    test_definitions_list.append(test_definition)
 
-        return test_definitions_list
+    def get_changed_tests(self, cartesian: List[TestDefinition]):
+        '''
+            Splits the cartesian product into the tests which must run and the tests which can be carried over from the last run. A test
+            is carried over when nothing it depends on changed (see get_inputs_hash) and it passed last time. The tests a changed test
+            depends on (see set_test_dependencies) run again too, so the changed test does not run without them. Returns both lists,
+            the carried over tests already hold their last result.
+        '''
+        test_history = TestHistory(self.trav_con)
+        test_lookup = {test_def.test_id: test_def for test_def in cartesian}
+        last_results = {}
+        changed_ids = set()
+
+        for test_def in cartesian:
+            last_result = test_history.get_last_result(test_def)
+            last_results[test_def.test_id] = last_result
+
+            if last_result is None or last_result['inputsHash'] != test_def.inputs_hash \
+               or last_result['testStatus'] != TestStatus.PASSED:
+                changed_ids.add(test_def.test_id)
+
+        # The dependencies of a changed test are added to the run, and their own dependencies after them
+        dependency_ids = [dependency_id for test_id in changed_ids for dependency_id in test_lookup[test_id].depends_on]
+        while len(dependency_ids) > 0:
+            dependency_id = dependency_ids.pop()
+            if dependency_id in test_lookup and dependency_id not in changed_ids:
+                changed_ids.add(dependency_id)
+                dependency_ids.extend(test_lookup[dependency_id].depends_on)
+
+        changed_tests = []
+        carried_over_tests = []
+        for test_def in cartesian:
+            if test_def.test_id in changed_ids:
+                changed_tests.append(test_def)
+                continue
+
+            last_result = last_results[test_def.test_id]
+            test_def.test_status = last_result['testStatus']
+            test_def.test_start_time = datetime.fromisoformat(last_result['testStartTime']) if last_result['testStartTime'] else None
+            test_def.test_end_time = datetime.fromisoformat(last_result['testEndTime']) if last_result['testEndTime'] else None
+            test_def.comments = f"Carried over from the last run ({last_result['testEndTime']}), nothing it depends on changed. " \
+                                f"{last_result['comments']}"
+            carried_over_tests.append(test_def)
+
+        return changed_tests, carried_over_tests
+
+
+    def set_test_dependencies(self, cartesian: List[TestDefinition]):
+        '''
+            Sets depends_on of every test in the cartesian product going by the testDependencies of its suite json, for example
+            "testDependencies": {"edit_user": ["create_user"]}. A test depends on the tests named in the same suite and capability,
+            only on the ones with the same test config if the dependency has it, otherwise on all of them. A dependency which is not
+            part of the test run is not waited for. Raises an exception for an unknown test name or a dependency cycle.
+        '''
+        suite_tests = {}
+        for test_def in cartesian:
+            suite_key = (test_def.test_pack, test_def.test_suite, test_def.capability)
+            suite_tests.setdefault(suite_key, {}).setdefault(test_def.test_name, []).append(test_def)
+
+        suite_test_names = {}
+        for test_def in cartesian:
+            test_dependencies = (test_def.tests_json or {}).get('testDependencies', {})
+            test_def.depends_on = []
+
+            for dependency_name in test_dependencies.get(test_def.test_name, []):
+                if (test_def.test_pack, test_def.test_suite) not in suite_test_names:
+                    suite_test_names[(test_def.test_pack, test_def.test_suite)] = \
+                        [test_item[2] for test_item in self._get_all_test_cases_in_test_suite(test_def.test_pack, test_def.test_suite)]
+
+                if dependency_name not in suite_test_names[(test_def.test_pack, test_def.test_suite)]:
+                    raise Exception(f'The test {test_def.test_name} in {test_def.test_pack}/{test_def.test_suite} depends on '
+                                    f'{dependency_name}, which is not a test in that suite.')
+
+                dependency_defs = suite_tests[(test_def.test_pack, test_def.test_suite, test_def.capability)].get(dependency_name, [])
+                same_config_defs = [dependency_def for dependency_def in dependency_defs
+                                    if dependency_def.test_config_title == test_def.test_config_title
+                                    and dependency_def.test_config_value == test_def.test_config_value]
+                test_def.depends_on.extend(dependency_def.test_id for dependency_def in same_config_defs or dependency_defs)
+
+        self._check_dependency_cycles(cartesian)
+
+
+    def _check_dependency_cycles(self, cartesian: List[TestDefinition]):
+        ''' Raises an exception if the tests depend on each other in a circle, those tests could never start. '''
+        test_lookup = {test_def.test_id: test_def for test_def in cartesian}
+        checked_ids = set()
+
+        for test_def in cartesian:
+            path = [] # The tests being followed, a test which shows up on its own path is a cycle
+            stack = [(test_def.test_id, False)]
+
+            while len(stack) > 0:
+                test_id, leaving = stack.pop()
+                if leaving:
+                    path.remove(test_id)
+                    checked_ids.add(test_id)
+                    continue
+
+                if test_id in path:
+                    cycle = ' -> '.join(test_lookup[cycle_id].test_name for cycle_id in path[path.index(test_id):] + [test_id])
+                    raise Exception(f'The test dependencies of {test_def.test_pack}/{test_def.test_suite} have a cycle: {cycle}')
+
+                if test_id in checked_ids:
+                    continue
+
+                path.append(test_id)
+                stack.append((test_id, True))
+                stack.extend((dependency_id, False) for dependency_id in test_lookup[test_id].depends_on)
+
+
+    def get_dependency_groups(self, cartesian: List[TestDefinition]) -> List[List[TestDefinition]]:
+        ''' Returns the tests grouped so that tests which depend on each other, directly or through other tests, are in the same group. '''
+        group_of = {test_def.test_id: test_def.test_id for test_def in cartesian}
+
+        def find_group(test_id):
+            while group_of[test_id] != test_id:
+                group_of[test_id] = group_of[group_of[test_id]]
+                test_id = group_of[test_id]
+            return test_id
+
+        for test_def in cartesian:
+            for dependency_id in test_def.depends_on:
+                if dependency_id in group_of:
+                    group_of[find_group(dependency_id)] = find_group(test_def.test_id)
+
+        groups = {}
+        for test_def in cartesian:
+            groups.setdefault(find_group(test_def.test_id), []).append(test_def)
+
+        return list(groups.values())
+
+
+    def get_test_shard(self, cartesian: List[TestDefinition], shard: str) -> List[TestDefinition]:
+        '''
+            Splits the cartesian product into shards and returns the tests of one shard. Pass in the shard as i/n, for example 2/4 is
+            the 2nd of 4 shards. Every shard works out the same split on its own, so the shards of a test run need the same tests and the
+            same test history. With history the tests are balanced by expected duration, longest first onto the shard with the least
+            work. Without history each test is placed by a stable hash of its name. Tests which depend on each other stay in one shard.
+        '''
+        try:
+            shard_index, shard_count = [int(value) for value in shard.split('/')]
+        except ValueError as error:
+            raise Exception(f'Invalid shard {shard}, it must look like 2/4') from error
+
+        if shard_count < 1 or shard_index < 1 or shard_index > shard_count:
+            raise Exception(f'Invalid shard {shard}, the shard number must be between 1 and the number of shards')
+
+        test_history = TestHistory(self.trav_con)
+        # Each group is placed by the first of its test keys, so every shard picks the same key no matter the order of the tests
+        test_groups = [(min(TestHistory.key_for(test_def) for test_def in test_group), test_group)
+                       for test_group in self.get_dependency_groups(cartesian)]
+
+        if len(test_history.durations) == 0:
+            return [test_def for group_key, test_group in test_groups
+                    if zlib.crc32(group_key.encode('utf-8')) % shard_count == shard_index - 1 for test_def in test_group]
+
+        expected_durations = test_history.get_expected_durations(cartesian)
+        group_durations = {group_key: sum(expected_durations[test_def.test_id] for test_def in test_group)
+                           for group_key, test_group in test_groups}
+        ordered_groups = sorted(test_groups, key=lambda group: (-group_durations[group[0]], group[0]))
+        shard_totals = [0.0] * shard_count
+        shard_tests = []
+
+        for group_key, test_group in ordered_groups:
+            lightest_shard = shard_totals.index(min(shard_totals))
+            shard_totals[lightest_shard] += group_durations[group_key]
+            if lightest_shard == shard_index - 1:
+                shard_tests.extend(test_group)
+
+        return shard_tests
 
 
     def global_setup(self):
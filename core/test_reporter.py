@@ -3,6 +3,7 @@
 
 from datetime                   import datetime, timedelta
 import os
+import json
 from typing                     import List
 import warnings
 import subprocess
@@ -17,6 +18,8 @@ from core.core_models           import TestDefinition, TestStatus, ReportDeliver
 from utilities.terminal         import ColorCodes
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+RESULTS_FILE_NAME = 'test_results.json'
+MEMORY_GROWTH_TO_FLAG = 5 # The number of tests with the biggest worker memory growth which are flagged in the report
 
 class ReporterTasks:
     ''' This class is used to wrap functionality for re-use into methods, its an entry point for other parts of
@@ -37,8 +40,13 @@ class ReporterTasks:
             color = ColorCodes.YELLOW
         elif test_def.test_status == TestStatus.BLOCKED:
             color = ColorCodes.CITALIC
+        else:
+            color = ColorCodes.LIGHT_GREY
 
-        test_duration = test_def.test_end_time - test_def.test_start_time
+        if test_def.test_end_time is None or test_def.test_start_time is None: # The test never ran
+            test_duration = '0'
+        else:
+            test_duration = test_def.test_end_time - test_def.test_start_time
         # Print to Terminal
         tqdm.write(f'''\n{color}
                 Test: {test_def.test_pack} - {test_def.test_suite} - {test_def.test_name} - {test_def.platform} - {test_def.capability}
@@ -50,51 +58,42 @@ class ReporterTasks:
                 ''')
 
     @staticmethod
-    def build_test_results_html(test_results: List[TestDefinition], trav_con:TraverseConfig=None):
-        ''' This method builds and returns the default html code stored in test_report_default.html '''
-        # First create an empty string object
-        html_rows = ''
-        css_class_passed = 'background-color: #3cc47c;'
-        css_class_failed = 'background-color: #e24e42;'
-        css_class_blocked = 'background-color: #cccccc;'
-        css_class_retest = 'background-color: #ffe400;'
-
-        # These variables will be used in the loop below to tally totals
-        total_tests = len(test_results)
-        total_passed = 0
-        total_failed = 0
-        total_blocked = 0
-        total_retest = 0
-        total_untested = 0
-        total_runtime = '--:--:--'
-
-        # Now loop and concatenate each row to the html string
-        for test in test_results:
-            if test.test_status == TestStatus.PASSED:
-                css_for_row = css_class_passed
-                total_passed += 1
-            elif test.test_status == TestStatus.FAILED:
-                css_for_row = css_class_failed
-                total_failed += 1
-            elif test.test_status == TestStatus.RETEST:
-                css_for_row = css_class_retest
-                total_retest += 1
-            elif test.test_status == TestStatus.BLOCKED:
-                css_for_row = css_class_blocked
-                total_blocked += 1
-            elif test.test_status == TestStatus.UNTESTED:
-                total_untested += 1
+    def get_memory_growth_tests(test_results: List[TestDefinition]) -> List[TestDefinition]:
+        '''
+            Returns the tests after which the memory of their worker grew the most, biggest first. Only tests which grew the memory
+            are returned, at most MEMORY_GROWTH_TO_FLAG of them. These are the first tests to look at when a worker leaks memory.
+        '''
+        grown_tests = [test for test in test_results if test.memory_before is not None and test.memory_after is not None
+                       and test.memory_after > test.memory_before]
+        grown_tests.sort(key=lambda test: test.memory_after - test.memory_before, reverse=True)
+        return grown_tests[:MEMORY_GROWTH_TO_FLAG]
 
-            if test.test_end_time is None or test.test_start_time is None:
-                test_duration = '0'
-            else:
-                test_duration = test.test_end_time - test.test_start_time
-                if total_runtime == '--:--:--':
-                    total_runtime = test_duration
-                else:
-                    total_runtime = total_runtime + test_duration
 
-            html_row = f'''
+    @staticmethod
+    def get_memory_growth_mb(test_def: TestDefinition):
+        ''' Returns how many MB the memory of the worker grew during the test passed in. '''
+        return (test_def.memory_after - test_def.memory_before) / 1024 / 1024
+
+
+    @staticmethod
+    def build_test_result_row(test: TestDefinition):
+        ''' Builds and returns the html row of one test for the results table of the default html report. '''
+        css_for_row = ''
+        if test.test_status == TestStatus.PASSED:
+            css_for_row = 'background-color: #3cc47c;'
+        elif test.test_status == TestStatus.FAILED:
+            css_for_row = 'background-color: #e24e42;'
+        elif test.test_status == TestStatus.RETEST:
+            css_for_row = 'background-color: #ffe400;'
+        elif test.test_status == TestStatus.BLOCKED:
+            css_for_row = 'background-color: #cccccc;'
+
+        if test.test_end_time is None or test.test_start_time is None:
+            test_duration = '0'
+        else:
+            test_duration = test.test_end_time - test.test_start_time
+
+        return f'''
                         <tr style="{css_for_row}">
                             <td style="padding: 2px;">{test.test_id}</td>
                             <td style="padding: 2px;">{test.test_pack}</td>
@@ -108,36 +107,38 @@ class ReporterTasks:
                             <td style="padding: 2px;">{test.comments}</td>
                         </tr>
                         '''
-            html_rows = html_rows + html_row
 
-        # Prepare the summary HTML
-        html_summary = f'''
-                <tr style="">
-                    <td style="padding: 2px;">{trav_con.environment}</td>
-                    <td style="padding: 2px;">{total_tests}</td>
-                    <td style="padding: 2px;">{total_passed}</td>
-                    <td style="padding: 2px;">{total_failed}</td>
-                    <td style="padding: 2px;">{total_untested}</td>
-                    <td style="padding: 2px;">{total_blocked}</td>
-                    <td style="padding: 2px;">{total_runtime}</td>
-                </tr>
-            '''
 
-        # Read/Load the template file
-        if platform.system() == 'Windows':
-            file_loc = f'{CURRENT_DIR}\\html_report\\test_report_default.html'
-        else:
-            file_loc = f'{CURRENT_DIR}/html_report/test_report_default.html'
-        with open(file_loc, 'r') as f_in:
-            f_data = f_in.read()
+    @staticmethod
+    def build_memory_rows(test_results: List[TestDefinition]):
+        ''' Builds and returns the html rows of the tests with the biggest memory growth of their worker. '''
+        html_memory_rows = ''
+        for test in ReporterTasks.get_memory_growth_tests(test_results):
+            html_memory_rows = html_memory_rows + f'''
+                        <tr>
+                            <td style="padding: 2px;">{test.test_id}</td>
+                            <td style="padding: 2px;">{test.test_pack} - {test.test_suite} - {test.test_name}</td>
+                            <td style="padding: 2px;">{test.test_config_title} : {test.test_config_value}</td>
+                            <td style="padding: 2px;">{test.memory_before / 1024 / 1024:.1f} MB</td>
+                            <td style="padding: 2px;">{test.memory_after / 1024 / 1024:.1f} MB</td>
+                            <td style="padding: 2px; font-weight: bold;">+{ReporterTasks.get_memory_growth_mb(test):.1f} MB</td>
+                        </tr>
+                        '''
+        if html_memory_rows == '':
+            html_memory_rows = '<tr><td colspan=6 style="padding: 2px;">No test grew the memory of its worker</td></tr>'
 
-        # Replace the token with our string of html markup
-        f_data = f_data.replace('$$data_rows$$', html_rows).replace('$$summary_rows$$', html_summary)
+        return html_memory_rows
 
-        if trav_con is not None:
-            f_data = f_data.replace('$$test_plan_name$$', trav_con.test_run_name)
 
-        return f_data
+    @staticmethod
+    def build_test_results_html(test_results: List[TestDefinition], trav_con:TraverseConfig):
+        ''' This method builds and returns the default html code stored in test_report_default.html, for the test results passed in. '''
+        reporter = Reporter(trav_con)
+        for test in test_results:
+            reporter.count_result(test)
+            reporter.add_html_row(test)
+
+        return reporter.build_report_html()
 
     @staticmethod
     def build_custom_html_comments_only(test_results: List[TestDefinition], template_name):
@@ -167,46 +168,177 @@ class ReporterTasks:
         return f_data
 
 
+    @staticmethod
+    def load_results_json(results_path) -> List[TestDefinition]:
+        '''
+            Loads the test results saved by the json report method. Pass in the path of the results file or the test run result
+            directory it is in. This is used to merge the results of a sharded test run into one report.
+        '''
+        if os.path.isdir(results_path):
+            results_path = os.path.join(results_path, RESULTS_FILE_NAME)
+
+        with open(results_path, 'r', encoding='utf-8') as f_in:
+            results_json = json.load(f_in)
+
+        return [TestDefinition.from_dict(test_dict) for test_dict in results_json['results']]
+
+
 class Reporter:
     '''
         The Reporter is responsible for accepting the test results, along with the traverse config, and reporting those
         results as per the method defined. This means if reporting results to cmd is set, it will report all test statuses
         to the terminal/console.
+
+        The reporter can also stream the results of a test run while it is busy, add its add_executor_result method as a result
+        listener of the executor. Every result updates the totals and the report rows as it comes in, close_report then only has to put
+        the report together and deliver it. Passing the results in and calling run_reporter does both in one go.
     '''
-    def __init__(self, traverse_config: TraverseConfig, test_results: List[TestDefinition]):
+    def __init__(self, traverse_config: TraverseConfig, test_results: List[TestDefinition] = None):
         self.trav_con = traverse_config
-        self.t_results = test_results
+        self.report_methods = traverse_config.reporter_settings.report_methods
+        self.t_results = []
         self.tests_passed = []
         self.tests_failed = []
         self.tests_untested = []
         self.tests_blocked = []
-        self.tests_total = len(test_results)
+        # Known flaky tests are reported on their own and do not count towards the results of the run
+        self.tests_quarantined = []
+        self.tests_total = 0
 
-        self.num_tests_passed = sum(test.test_status == TestStatus.PASSED for test in test_results)
-        self.num_tests_failed = sum(test.test_status == TestStatus.FAILED for test in test_results)
-        self.num_tests_untested = sum(test.test_status == TestStatus.UNTESTED for test in test_results)
-        self.num_tests_blocked = sum(test.test_status == TestStatus.BLOCKED for test in test_results)
+        self.num_tests_passed = 0
+        self.num_tests_failed = 0
+        self.num_tests_untested = 0
+        self.num_tests_blocked = 0
+
+        # The rows of the default html report, built as the results come in
+        self.html_rows = []
+        self.html_quarantine_rows = []
+        self.total_runtime = None
 
         if not os.path.exists(os.path.dirname(self.trav_con.reporter_settings.reports_folder)):
             os.makedirs(os.path.dirname(self.trav_con.reporter_settings.reports_folder), exist_ok=True)
 
+        for test in test_results or []:
+            self.add_result(test)
 
-    def run_reporter(self):
-        ''' This is the main entry into the reporter, by calling this method, the reporter will execute and report on all test results. '''
-        # First split the results
-        self.split_test_results()
-        if ReportDeliveryType.CMD in self.trav_con.reporter_settings.report_methods:
+
+    def add_result(self, test: TestDefinition, printed=False):
+        '''
+            Adds the result of a finished test to the report, it is counted and its report rows are written straight away. Pass in
+            printed as True if the result was already printed to the console, so it is not printed twice.
+        '''
+        self.count_result(test)
+
+        # Quarantined tests are reported to the console together when the report is closed
+        if ReportDeliveryType.CMD in self.report_methods and not test.quarantined and printed is False:
+            ReporterTasks.report_test_via_cmd(test)
+
+        if (ReportDeliveryType.HTML in self.report_methods or ReportDeliveryType.EMAIL in self.report_methods) \
+           and self.trav_con.reporter_settings.html_template == '':
+            self.add_html_row(test)
+
+
+    def add_executor_result(self, test: TestDefinition):
+        '''
+            The result listener to add to the executor to stream the results of a test run. With test result updates on, the
+            executor prints every result itself when the test finished.
+        '''
+        self.add_result(test, printed=self.trav_con.test_result_updates is True)
+
+
+    def count_result(self, test: TestDefinition):
+        ''' Adds the test passed in to the results and totals of the report. '''
+        self.t_results.append(test)
+
+        if test.quarantined:
+            self.tests_quarantined.append(test)
+        else:
+            self.tests_total += 1
+            if test.test_status == TestStatus.PASSED:
+                self.tests_passed.append(test)
+                self.num_tests_passed += 1
+            elif test.test_status == TestStatus.FAILED:
+                self.tests_failed.append(test)
+                self.num_tests_failed += 1
+            elif test.test_status == TestStatus.UNTESTED:
+                self.tests_untested.append(test)
+                self.num_tests_untested += 1
+            elif test.test_status == TestStatus.BLOCKED:
+                self.tests_blocked.append(test)
+                self.num_tests_blocked += 1
+            else:
+                warnings.warn('There are tests with statuses which could not be identified, this calls for an audit!')
+
+
+    def add_html_row(self, test: TestDefinition):
+        ''' Adds the row of the test passed in to the default html report, quarantined tests go in their own table. '''
+        if test.quarantined:
+            self.html_quarantine_rows.append(ReporterTasks.build_test_result_row(test))
+            return
+
+        self.html_rows.append(ReporterTasks.build_test_result_row(test))
+        if test.test_end_time is not None and test.test_start_time is not None:
+            test_duration = test.test_end_time - test.test_start_time
+            self.total_runtime = test_duration if self.total_runtime is None else self.total_runtime + test_duration
+
+
+    def build_report_html(self):
+        ''' Puts the default html report together out of the rows added so far and returns it. '''
+        html_summary = f'''
+                <tr style="">
+                    <td style="padding: 2px;">{self.trav_con.environment}</td>
+                    <td style="padding: 2px;">{self.tests_total}</td>
+                    <td style="padding: 2px;">{self.num_tests_passed}</td>
+                    <td style="padding: 2px;">{self.num_tests_failed}</td>
+                    <td style="padding: 2px;">{self.num_tests_untested}</td>
+                    <td style="padding: 2px;">{self.num_tests_blocked}</td>
+                    <td style="padding: 2px;">{self.total_runtime if self.total_runtime is not None else '--:--:--'}</td>
+                </tr>
+            '''
+
+        html_quarantine_rows = ''.join(self.html_quarantine_rows)
+        if html_quarantine_rows == '':
+            html_quarantine_rows = '<tr><td colspan=10 style="padding: 2px;">No tests were quarantined</td></tr>'
+
+        # Read/Load the template file
+        if platform.system() == 'Windows':
+            file_loc = f'{CURRENT_DIR}\\html_report\\test_report_default.html'
+        else:
+            file_loc = f'{CURRENT_DIR}/html_report/test_report_default.html'
+        with open(file_loc, 'r') as f_in:
+            f_data = f_in.read()
+
+        # Replace the token with our string of html markup
+        f_data = f_data.replace('$$data_rows$$', ''.join(self.html_rows)).replace('$$summary_rows$$', html_summary)
+        f_data = f_data.replace('$$memory_rows$$', ReporterTasks.build_memory_rows(self.t_results))
+        f_data = f_data.replace('$$quarantine_rows$$', html_quarantine_rows)
+        f_data = f_data.replace('$$test_plan_name$$', self.trav_con.test_run_name)
+
+        return f_data
+
+
+    def close_report(self):
+        ''' Finishes the report of the results added so far and delivers it by every report method of the reporter settings. '''
+        if ReportDeliveryType.CMD in self.report_methods:
             self.report_via_cmd()
 
-        if ReportDeliveryType.HTML in self.trav_con.reporter_settings.report_methods:
+        if ReportDeliveryType.HTML in self.report_methods:
             self.report_via_html_file()
 
-        if ReportDeliveryType.EMAIL in self.trav_con.reporter_settings.report_methods:
+        if ReportDeliveryType.EMAIL in self.report_methods:
             self.report_via_email()
 
+        if ReportDeliveryType.JSON in self.report_methods:
+            self.report_via_json_file()
+
         self.cleanup_report_history()
 
 
+    def run_reporter(self):
+        ''' This is the main entry into the reporter, by calling this method, the reporter will execute and report on all test results. '''
+        self.close_report()
+
+
     def cleanup_report_history(self):
         ''' This method will clean up any report history based off the reporter settings. '''
 
@@ -225,33 +357,28 @@ class Reporter:
                         shutil.rmtree(full_path)
 
 
-    def split_test_results(self):
-        ''' This method splits the results into seperate lists. This is used for reporting statistics. '''
-        for test in self.t_results:
-            if test.test_status == TestStatus.PASSED:
-                self.tests_passed.append(test)
-            elif test.test_status == TestStatus.FAILED:
-                self.tests_failed.append(test)
-            elif test.test_status == TestStatus.UNTESTED:
-                self.tests_untested.append(test)
-            elif test.test_status == TestStatus.BLOCKED:
-                self.tests_blocked.append(test)
-            else:
-                warnings.warn('There are tests with statuses which could not be identified, this calls for an audit!')
-
-
     def report_via_cmd(self):
-        ''' The method used to report ALL results to the console, it takes no parameters because the test results are
-            passed to the reporter class when the Reporter class is initialised '''
-        for test in self.t_results:
-            ReporterTasks.report_test_via_cmd(test)
+        ''' Reports what is left once every result was reported to the console as it came in, the quarantined tests and the tests
+            with the biggest memory growth of their worker. '''
+        if len(self.tests_quarantined) > 0:
+            tqdm.write(f'\n{ColorCodes.YELLOW}Quarantined tests, known to be flaky and not counted towards the results of the run:{ColorCodes.ENDC}')
+            for test in self.tests_quarantined:
+                ReporterTasks.report_test_via_cmd(test)
+
+        memory_growth_tests = ReporterTasks.get_memory_growth_tests(self.t_results)
+        if len(memory_growth_tests) > 0:
+            tqdm.write(f'\n{ColorCodes.YELLOW}Tests with the biggest memory growth of their worker:')
+            for test in memory_growth_tests:
+                tqdm.write(f'                +{ReporterTasks.get_memory_growth_mb(test):.1f} MB - {test.test_pack} - {test.test_suite} - '
+                           f'{test.test_name} - {test.test_config_title} : {test.test_config_value}')
+            tqdm.write(ColorCodes.ENDC)
 
 
     def report_via_html_file(self):
         ''' This method will report all test results by building an html page and opening up in a browser '''
 
         if self.trav_con.reporter_settings.html_template == '':
-            html_data_file = ReporterTasks.build_test_results_html(self.t_results, self.trav_con)
+            html_data_file = self.build_report_html()
         else:
             html_data_file = ReporterTasks.build_custom_html_comments_only(self.t_results, self.trav_con.reporter_settings.html_template)
 
@@ -269,6 +396,20 @@ class Reporter:
             subprocess.call(("xdg-open", file_loc))
 
 
+    def report_via_json_file(self):
+        ''' Saves all test results to a json file in the test run result directory, so they can be loaded again (like merging shards). '''
+        os.makedirs(self.trav_con.testrun_result_dir, exist_ok=True)
+        results_json = {
+            'testRunName': self.trav_con.test_run_name,
+            'environment': self.trav_con.environment,
+            'results': [test.to_dict() for test in self.t_results]
+        }
+
+        file_loc = self.trav_con.testrun_result_dir + RESULTS_FILE_NAME
+        with open(file_loc, 'w', encoding='utf-8') as f_out:
+            json.dump(results_json, f_out, indent=4)
+
+
     def report_via_email(self):
         '''
             This method uses standard python libraries to send an email to the settings in the traverse config.
@@ -292,7 +433,7 @@ class Reporter:
         email_msg['Subject'] = email_subject
 
         if self.trav_con.reporter_settings.html_template == '':
-            email_body = ReporterTasks.build_test_results_html(self.t_results, self.trav_con)
+            email_body = self.build_report_html()
         else:
             email_body = ReporterTasks.build_custom_html_comments_only(self.t_results, self.trav_con.reporter_settings.html_template)
 
@@ -0,0 +1,120 @@
+''' Test selection picks the tests of a test run by their tags. Tags are declared on test methods with the tags decorator, or in the
+    suite json with "tags" (every test of the suite) and "testTags" (per test). A test run selects tests with a boolean tag expression
+    like "smoke and not slow", set as tagExpression in the test run file or with --tags on the command line. '''
+import re
+from typing                 import Dict, List, Set
+
+
+def tags(*tag_names):
+    '''
+        Declares the tags of a test method, for example @tags('smoke', 'payments'). The tags are read from the suite file without
+        importing it, so pass the tag names in as plain strings.
+    '''
+    def add_tags(test_method):
+        test_method.test_tags = list(tag_names)
+        return test_method
+
+    return add_tags
+
+
+class TagExpression:
+    '''
+        A boolean expression over test tags, made of tag names, and, or, not and brackets. Not binds the strongest, then and, then or,
+        so "smoke and not slow or db" means "(smoke and (not slow)) or db". Tag names are not case sensitive.
+    '''
+    TOKEN_PATTERN = re.compile(r'\s*(\(|\)|[^\s()]+)')
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = self.TOKEN_PATTERN.findall(expression)
+        self.position = 0
+        self.tree = self._parse_or()
+        if self.position < len(self.tokens):
+            raise Exception(f'Invalid tag expression: {expression}, did not expect {self.tokens[self.position]}')
+
+
+    def _next_token(self):
+        ''' Returns the token at the current position, lower cased, or None at the end of the expression. '''
+        return self.tokens[self.position].lower() if self.position < len(self.tokens) else None
+
+
+    def _parse_or(self):
+        ''' Parses the terms joined by or from the current position. '''
+        node = self._parse_and()
+        while self._next_token() == 'or':
+            self.position += 1
+            node = ('or', node, self._parse_and())
+        return node
+
+
+    def _parse_and(self):
+        ''' Parses the factors joined by and from the current position. '''
+        node = self._parse_not()
+        while self._next_token() == 'and':
+            self.position += 1
+            node = ('and', node, self._parse_not())
+        return node
+
+
+    def _parse_not(self):
+        ''' Parses a tag, a negated factor or an expression in brackets from the current position. '''
+        token = self._next_token()
+        if token is None or token in ('and', 'or', ')'):
+            raise Exception(f'Invalid tag expression: {self.expression}, expected a tag at {token or "the end"}')
+
+        self.position += 1
+        if token == 'not':
+            return ('not', self._parse_not())
+
+        if token == '(':
+            node = self._parse_or()
+            if self._next_token() != ')':
+                raise Exception(f'Invalid tag expression: {self.expression}, a bracket is not closed')
+            self.position += 1
+            return node
+
+        return ('tag', token)
+
+
+    def evaluate(self, tag_index: 'TagIndex') -> Set[int]:
+        ''' Returns the positions of the tests in the tag index passed in which match the expression. '''
+        return self._evaluate_node(self.tree, tag_index)
+
+
+    def _evaluate_node(self, node, tag_index: 'TagIndex') -> Set[int]:
+        ''' Returns the positions of the tests which match the part of the expression passed in. '''
+        if node[0] == 'tag':
+            return tag_index.tests_by_tag.get(node[1], set())
+        if node[0] == 'not':
+            return tag_index.get_all_positions() - self._evaluate_node(node[1], tag_index)
+        if node[0] == 'and':
+            return self._evaluate_node(node[1], tag_index) & self._evaluate_node(node[2], tag_index)
+        return self._evaluate_node(node[1], tag_index) | self._evaluate_node(node[2], tag_index)
+
+
+class TagIndex:
+    '''
+        An inverted index from tag to the tests which have it. Tests are added as [test pack, test suite, test case] with their
+        tags, a tag expression then selects them with set operations instead of looking at every test.
+    '''
+    def __init__(self):
+        self.tests: List[List] = []
+        self.tests_by_tag: Dict[str, Set[int]] = {}
+
+
+    def add_test(self, test_item: List, test_tags: List[str]):
+        ''' Adds a test with its tags to the index. '''
+        position = len(self.tests)
+        self.tests.append(test_item)
+        for tag_name in test_tags:
+            self.tests_by_tag.setdefault(str(tag_name).lower(), set()).add(position)
+
+
+    def get_all_positions(self) -> Set[int]:
+        ''' Returns the positions of every test in the index. '''
+        return set(range(len(self.tests)))
+
+
+    def select(self, expression: str) -> List[List]:
+        ''' Returns the tests which match the tag expression passed in, in the order they were added. '''
+        return [self.tests[position] for position in sorted(TagExpression(expression).evaluate(self))]
@@ -0,0 +1,424 @@
+''' This module holds the executor's worker processes. The WorkerPool starts and supervises the workers, the WorkerCache holds the
+    state a worker keeps for the whole test run so every worker warms up once instead of every test paying for imports and file loading. '''
+import sys
+import time
+import signal
+import asyncio
+import importlib
+from datetime               import datetime
+from multiprocessing        import Process, Pipe, connection
+from typing                 import Dict, List, Callable
+
+import psutil
+
+from tqdm                   import tqdm
+from core.core_models       import TraverseConfig, TestDefinition, SuiteRecord, TestTask, SuiteHooks
+from utilities.test_data    import TestData
+from utilities.screenshot_writer import ScreenshotWriter
+
+
+class WorkerCache:
+    '''
+        A per worker cache of everything a test needs which does not change during a test run. The attributes are class level on
+        purpose, each worker process gets its own copy of this class when the pool starts it.
+    '''
+    trav_con: TraverseConfig = None
+    suite_records: Dict[str, SuiteRecord] = {}
+    test_classes = {}
+    suite_fixtures = {}
+    suite_setup_errors: Dict[str, Exception] = {}
+    screenshot_writer: ScreenshotWriter = None
+    event_loop: asyncio.AbstractEventLoop = None
+
+
+    @staticmethod
+    def init_worker(traverse_config: TraverseConfig, suite_records: Dict[str, SuiteRecord]):
+        '''
+            The initializer for the executor pool. Pass in the traverse config and the suite records of the test run keyed by suite key.
+            This is the only time these are sent to the worker, the test modules, test data and driver configs are loaded here once
+            for the life of the worker. A warm worker which is set up again for another test run (see WorkerPool.reinitialize) keeps
+            the test modules it imported, its suite fixtures and its browser sessions.
+        '''
+        WorkerCache.trav_con = traverse_config
+        WorkerCache.suite_records = suite_records
+        WorkerCache.suite_setup_errors = {} # A warm worker which is set up for another test run gives failed suite setups another go
+
+        if WorkerCache.screenshot_writer is not None:
+            WorkerCache.screenshot_writer.close()
+        WorkerCache.screenshot_writer = ScreenshotWriter(traverse_config.screenshot_format, traverse_config.screenshot_quality,
+                                                         traverse_config.screenshot_compression)
+
+        for suite_record in suite_records.values():
+            try:
+                WorkerCache.get_test_class(suite_record.test_pack, suite_record.test_suite)
+            except Exception: # A broken suite must not kill the worker, the test itself will report the error when it executes.
+                pass
+
+        # Loading the test data once fills the csv cache in TestData for every test that follows.
+        TestData()
+
+        # Only warm the driver if one of the suites pulled it in, API only runs should not pay for it.
+        driver_interface = sys.modules.get('driver.driver_interface')
+        if driver_interface is not None:
+            driver_helper = driver_interface.DriverHelper()
+            for capability in traverse_config.capabilities:
+                try:
+                    driver_helper.load_capability(traverse_config.platform, capability)
+                except Exception:
+                    pass
+
+
+    @staticmethod
+    def get_test_class(test_pack, test_suite):
+        ''' Returns the Tests class of the test suite passed in. The module is imported the first time, after that it comes from the cache. '''
+        suite_key = SuiteRecord.key_for(test_pack, test_suite)
+
+        if suite_key not in WorkerCache.test_classes:
+            test_module = importlib.import_module(f'tests.{test_pack}.{test_suite}')
+            WorkerCache.test_classes[suite_key] = getattr(test_module, 'Tests')
+
+        return WorkerCache.test_classes[suite_key]
+
+
+    @staticmethod
+    def get_suite_fixture(test_pack, test_suite):
+        '''
+            Returns what the setup_suite hook of the test suite returned, None if the suite has no hook. The hook only runs the first
+            time, after that the fixture comes from the cache. It is also set on the Tests class, so tests can use self.suite_fixture.
+            If the hook failed, its error is raised again for every test of the suite instead of running the hook again.
+        '''
+        suite_key = SuiteRecord.key_for(test_pack, test_suite)
+
+        if suite_key in WorkerCache.suite_setup_errors:
+            raise WorkerCache.suite_setup_errors[suite_key]
+
+        if suite_key not in WorkerCache.suite_fixtures:
+            test_class = WorkerCache.get_test_class(test_pack, test_suite)
+            setup_suite = getattr(test_class, SuiteHooks.SETUP, None)
+            try:
+                suite_fixture = setup_suite(WorkerCache.trav_con) if setup_suite is not None else None
+            except Exception as err:
+                WorkerCache.suite_setup_errors[suite_key] = err
+                raise
+
+            WorkerCache.suite_fixtures[suite_key] = suite_fixture
+            test_class.suite_fixture = suite_fixture
+
+        return WorkerCache.suite_fixtures[suite_key]
+
+
+    @staticmethod
+    def shutdown_worker():
+        '''
+            The finalizer for the executor pool. Runs the teardown_suite hook of every suite this worker set up and waits for the
+            failure screenshots still being written.
+        '''
+        for suite_key, suite_fixture in WorkerCache.suite_fixtures.items():
+            teardown_suite = getattr(WorkerCache.test_classes[suite_key], SuiteHooks.TEARDOWN, None)
+            if teardown_suite is None:
+                continue
+
+            try:
+                teardown_suite(WorkerCache.trav_con, suite_fixture)
+            except Exception as err: # One broken teardown must not stop the others
+                tqdm.write(f'\nThe suite teardown of {suite_key} failed: {type(err).__name__}: {err}')
+
+        WorkerCache.suite_fixtures.clear()
+        WorkerCache.screenshot_writer.close()
+
+
+    @staticmethod
+    def get_test_definition(test_task: TestTask) -> TestDefinition:
+        ''' Turns the lean test task the worker received back into a full test definition using the cached suite records. '''
+        return test_task.to_test_definition(WorkerCache.suite_records[test_task.suite_key], WorkerCache.trav_con.platform)
+
+
+    @staticmethod
+    def get_event_loop() -> asyncio.AbstractEventLoop:
+        ''' Returns the event loop of this worker which async tests are executed on. There is one loop per worker for the whole test run. '''
+        if WorkerCache.event_loop is None:
+            WorkerCache.event_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(WorkerCache.event_loop)
+
+        return WorkerCache.event_loop
+
+
+class WorkOutcome:
+    '''
+        What a worker pool hands back for a work item. The results are None if the worker failed, the failure comment says why.
+        If requeue is True the work item was lost without being executed (like an agent going away) and must be executed again.
+    '''
+    def __init__(self, work_item, results, failure_comment, started_at: datetime, requeue=False):
+        self.work_item = work_item
+        self.results = results
+        self.failure_comment = failure_comment
+        self.started_at = started_at
+        self.requeue = requeue
+
+
+class WorkerSetup:
+    ''' Sent to a warm worker in place of a work item to run the initializer again with new initargs, for the next test run. '''
+    def __init__(self, initargs):
+        self.initargs = initargs
+
+
+class WorkerProcess:
+    ''' A single executor worker process and the work item it is busy with, if any. The parent talks to it over its own pipe. '''
+    def __init__(self, worker_id, task_function: Callable, initializer: Callable, initargs, finalizer: Callable = None):
+        self.worker_id = worker_id
+        self.connection, child_connection = Pipe()
+        self.process = Process(target=WorkerPool.run_worker, args=(child_connection, task_function, initializer, initargs, finalizer),
+                               daemon=True)
+        self.process.start()
+        child_connection.close()
+
+        self.work_item = None
+        self.started_at: datetime = None
+        self.timeout = None
+        self.deadline = None
+        self.tests_done = 0
+
+
+    def is_idle(self):
+        ''' Returns True if this worker is not busy with a work item. '''
+        return self.work_item is None
+
+
+    def kill(self):
+        ''' Kills the worker process and anything it started, like browser drivers. '''
+        try:
+            worker = psutil.Process(self.process.pid)
+            for child in worker.children(recursive=True):
+                child.kill()
+            worker.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+        self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+    '''
+        A pool of executor worker processes which, unlike multiprocessing.Pool, keeps track of what every worker is busy with. A work
+        item can be given a timeout, if it runs over, the worker is killed, the work item is handed back as failed and a new worker
+        takes its place. The same happens when a worker dies unexpectedly. The optional finalizer runs in every worker when it shuts
+        down cleanly, a worker which is killed can not run it. To keep long test runs from piling up memory in the workers, a worker
+        can be recycled (shut down cleanly and replaced) after max tests or once its memory goes over max memory mb.
+    '''
+    POLL_INTERVAL = 1 # Seconds, the longest the pool waits for results before checking timeouts again
+
+    def __init__(self, num_of_workers, task_function: Callable, initializer: Callable, initargs, finalizer: Callable = None,
+                 max_tests=0, max_memory_mb=0):
+        self.task_function = task_function
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.max_tests = max_tests
+        self.max_memory_mb = max_memory_mb
+        self.next_worker_id = 0
+        self.target_size = num_of_workers
+        self.workers: List[WorkerProcess] = [self._start_worker() for _ in range(num_of_workers)]
+        self.stopping_workers: List[WorkerProcess] = [] # Workers taken out of the pool which did not exit yet
+
+
+    @staticmethod
+    def run_worker(worker_connection, task_function: Callable, initializer: Callable, initargs, finalizer: Callable = None):
+        '''
+            The main loop of a worker process. It warms up with the initializer then executes work items until it receives None,
+            then runs the finalizer.
+        '''
+        # Ctrl+c is for the executor, it shuts the workers down so they can clean up after themselves
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        initializer(*initargs)
+
+        try:
+            while True:
+                try:
+                    work_item = worker_connection.recv()
+                except EOFError: # The executor went away, nothing left to do.
+                    break
+
+                if work_item is None:
+                    break
+
+                if isinstance(work_item, WorkerSetup):
+                    initializer(*work_item.initargs)
+                    continue
+
+                try:
+                    worker_connection.send((task_function(work_item), None))
+                except Exception as err:
+                    worker_connection.send((None, f'{type(err).__name__}: {err}'))
+        finally:
+            if finalizer is not None:
+                finalizer()
+
+
+    def _start_worker(self):
+        ''' Starts a new worker process. '''
+        worker = WorkerProcess(self.next_worker_id, self.task_function, self.initializer, self.initargs, self.finalizer)
+        self.next_worker_id += 1
+        return worker
+
+
+    def _replace_worker(self, worker: WorkerProcess):
+        ''' Kills the worker passed in and starts a new one in its place. '''
+        worker.kill()
+        self.workers[self.workers.index(worker)] = self._start_worker()
+
+
+    def resize(self, num_of_workers):
+        '''
+            Grows or shrinks the pool to the number of workers passed in. New workers start straight away, idle workers are stopped
+            straight away and busy workers are stopped once they finished their work item.
+        '''
+        self.target_size = num_of_workers
+        while len(self.workers) < self.target_size:
+            self.workers.append(self._start_worker())
+
+        self._stop_extra_workers()
+
+
+    def _stop_extra_workers(self):
+        ''' Asks idle workers to shut down while the pool has more workers than its target size. '''
+        self.stopping_workers = [worker for worker in self.stopping_workers if worker.process.is_alive()]
+
+        while len(self.workers) > self.target_size:
+            idle_worker = next((worker for worker in self.workers if worker.is_idle()), None)
+            if idle_worker is None:
+                return
+
+            self.workers.remove(idle_worker)
+            self._stop_worker(idle_worker)
+
+
+    def _stop_worker(self, worker: WorkerProcess):
+        ''' Asks the idle worker passed in to shut down cleanly, it must already be out of the pool. '''
+        try:
+            worker.connection.send(None)
+        except OSError:
+            pass
+        self.stopping_workers.append(worker)
+
+
+    def _recycle_worker_if_due(self, worker: WorkerProcess):
+        ''' Shuts the idle worker passed in down cleanly and starts a new one in its place, if it executed max tests or uses max memory. '''
+        recycle_reason = None
+        if self.max_tests > 0 and worker.tests_done >= self.max_tests:
+            recycle_reason = f'executed {worker.tests_done} tests'
+        elif self.max_memory_mb > 0:
+            try:
+                memory_mb = psutil.Process(worker.process.pid).memory_info().rss / 1024 / 1024
+                if memory_mb > self.max_memory_mb:
+                    recycle_reason = f'uses {memory_mb:.0f} MB of memory'
+            except psutil.NoSuchProcess:
+                pass
+
+        if recycle_reason is not None:
+            tqdm.write(f'\nWorker {worker.worker_id} {recycle_reason}, recycling it.')
+            self.workers[self.workers.index(worker)] = self._start_worker()
+            self._stop_worker(worker)
+
+
+    def reinitialize(self, initargs):
+        '''
+            Runs the initializer of every worker again with the initargs passed in, so the warm workers can be used for another test
+            run. Workers started from now on use these initargs too. Only call this while no worker is busy.
+        '''
+        self.initargs = initargs
+        for worker in self.workers:
+            worker.connection.send(WorkerSetup(initargs))
+
+
+    def has_idle_worker(self):
+        ''' Returns True if at least one worker is free to take a work item. '''
+        return any(worker.is_idle() for worker in self.workers)
+
+
+    def is_busy(self):
+        ''' Returns True while any worker is still busy with a work item. '''
+        return any(not worker.is_idle() for worker in self.workers)
+
+
+    def submit(self, work_item, timeout=None):
+        ''' Hands the work item to an idle worker. If a timeout (seconds) is passed in, the worker is killed when it runs over. '''
+        worker = next(worker for worker in self.workers if worker.is_idle())
+        worker.work_item = work_item
+        worker.started_at = datetime.now()
+        worker.timeout = timeout
+        worker.deadline = time.monotonic() + timeout if timeout else None
+        worker.connection.send(work_item)
+
+
+    def get_results(self, timeout=None) -> List[WorkOutcome]:
+        '''
+            Waits until at least one worker is done and returns the outcome of every work item which finished. When a worker errored,
+            timed out or died, the outcome has no results and a failure comment instead. Dead or timed out workers are replaced.
+            Pass in a timeout (seconds) to return an empty list if nothing finished in that time.
+        '''
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            busy_workers = [worker for worker in self.workers if not worker.is_idle()]
+            wait_time = self.POLL_INTERVAL
+            if give_up_at is not None:
+                wait_time = max(0, min(wait_time, give_up_at - time.monotonic()))
+            deadlines = [worker.deadline for worker in busy_workers if worker.deadline is not None]
+            if len(deadlines) > 0:
+                wait_time = max(0, min(wait_time, min(deadlines) - time.monotonic()))
+
+            wait_list = [worker.connection for worker in busy_workers] + [worker.process.sentinel for worker in busy_workers]
+            ready = connection.wait(wait_list, timeout=wait_time)
+            outcomes = []
+
+            for worker in busy_workers:
+                if worker.connection in ready:
+                    try:
+                        results, error = worker.connection.recv()
+                        outcomes.append(WorkOutcome(worker.work_item, results, error, worker.started_at))
+                        worker.tests_done += len(worker.work_item)
+                        worker.work_item = None
+                        self._recycle_worker_if_due(worker)
+                        continue
+                    except (EOFError, OSError):
+                        pass # The worker died while sending, dealt with below
+
+                if worker.connection in ready or worker.process.sentinel in ready:
+                    tqdm.write(f'\nWorker {worker.worker_id} stopped unexpectedly, starting a new one.')
+                    failure_comment = 'The worker executing this test stopped unexpectedly.'
+                elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+                    tqdm.write(f'\nWorker {worker.worker_id} ran over its timeout of {worker.timeout} seconds, starting a new one.')
+                    failure_comment = f'Timeout Error, the test did not finish within {worker.timeout} seconds and was stopped.'
+                else:
+                    continue
+
+                outcomes.append(WorkOutcome(worker.work_item, None, failure_comment, worker.started_at))
+                self._replace_worker(worker)
+
+            if len(outcomes) > 0 or (give_up_at is not None and time.monotonic() >= give_up_at):
+                self._stop_extra_workers()
+                return outcomes
+
+
+    def close(self):
+        '''
+            Asks every idle worker to shut down cleanly, so anything they keep for the run is closed. Workers which do not stop are
+            killed. A worker still busy with a work item, like after ctrl+c, is killed straight away with anything it started,
+            instead of holding up the shutdown until its test finishes.
+        '''
+        idle_workers = []
+        for worker in self.workers:
+            if not worker.is_idle():
+                worker.kill()
+                continue
+
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+            idle_workers.append(worker)
+
+        for worker in idle_workers + self.stopping_workers:
+            worker.process.join(timeout=30)
+            if worker.process.is_alive():
+                worker.kill()
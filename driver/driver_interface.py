@@ -6,12 +6,15 @@ import platform
 import time
 import os
 from os.path                                    import realpath, dirname
+from multiprocessing                            import util
+from urllib.parse                               import urlparse
 
 from selenium                                   import webdriver, __version__
 from selenium.webdriver.common.action_chains    import ActionChains
 from selenium.webdriver.common.keys             import Keys
 from selenium.webdriver.support                 import expected_conditions as EC
 from selenium.webdriver.support.ui              import WebDriverWait
+from selenium.common.exceptions                 import WebDriverException
 
 from webdriver_manager.chrome                   import ChromeDriverManager
 from webdriver_manager.utils                    import ChromeType
@@ -55,7 +58,7 @@ class Hooks:
             self.hook_file = f'{CURRENT_DIR}\\hooks\\{hook_file_name}.json'
         else:
             self.hook_file = f'{CURRENT_DIR}/hooks/{hook_file_name}.json'
-        self.hooks = LoadJson.using_filepath(self.hook_file)
+        self.hooks = LoadJson.using_filepath_cached(self.hook_file)
 
     def get_hook(self, hook_name):
         ''' Pass in the name of the hook. This method returns 2 values, the 1st is the hook type (xpath, id, classname) and the
@@ -82,14 +85,23 @@ class DriverHelper:
         actions class. '''
     def __init__(self):
         if platform.system() == 'Windows':
-            self.driver_config = LoadJson.using_filepath(CURRENT_DIR + '\\driver_config.json')
+            self.driver_config = LoadJson.using_filepath_cached(CURRENT_DIR + '\\driver_config.json')
         else:
-            self.driver_config = LoadJson.using_filepath(CURRENT_DIR + '/driver_config.json')
+            self.driver_config = LoadJson.using_filepath_cached(CURRENT_DIR + '/driver_config.json')
 
         self.driver_name = GetJsonValue.by_key(self.driver_config, 'driverName')
         self.capability_dir = GetJsonValue.by_key(self.driver_config, 'capabilityDir')
         self.max_window_default = GetJsonValue.by_key(self.driver_config, 'maxWindowDefault')
 
+        # Session reuse settings, older driver configs may not have these so fall back to the defaults
+        self.reuse_sessions = GetJsonValue.by_key(self.driver_config, 'reuseSessions', ignore_key_attr_error=1)
+        if self.reuse_sessions is None:
+            self.reuse_sessions = True
+
+        self.max_session_uses = GetJsonValue.by_key(self.driver_config, 'maxSessionUses', ignore_key_attr_error=1)
+        if self.max_session_uses is None:
+            self.max_session_uses = 20
+
 
     def load_capability(self, platform_name, capability):
         ''' Pass in the platform and the capability name. This method returns a dictionary object of the capability. It will first determine
@@ -99,7 +111,7 @@ class DriverHelper:
                 raise Exception('Capability Not Found!')
 
             else:
-                cap_file = LoadJson.using_filepath(f'{CURRENT_DIR}\\{self.capability_dir}\\{platform_name}\\{capability}.json')
+                cap_file = LoadJson.using_filepath_cached(f'{CURRENT_DIR}\\{self.capability_dir}\\{platform_name}\\{capability}.json')
                 caps = {
                     'seleniumVersion': __version__,
                     'deviceName': cap_file['deviceName'],
@@ -117,7 +129,7 @@ class DriverHelper:
                 raise Exception('Capability Not Found!')
 
             else:
-                cap_file = LoadJson.using_filepath(f'{CURRENT_DIR}/{self.capability_dir}/{platform_name}/{capability}.json')
+                cap_file = LoadJson.using_filepath_cached(f'{CURRENT_DIR}/{self.capability_dir}/{platform_name}/{capability}.json')
                 caps = {
                     'seleniumVersion': __version__,
                     'deviceName': cap_file['deviceName'],
@@ -159,13 +171,132 @@ class DriverHelper:
         return driver
 
 
+class BrowserSession:
+    ''' A browser session handed out by the session pool. It keeps count of how many tests used it so it can be recycled. '''
+    def __init__(self, session_key, driver):
+        self.session_key = session_key
+        self.driver = driver
+        self.uses = 0
+        self.closed = False
+
+
+    def quit(self):
+        ''' Closes the browser of this session, any errors are ignored because the browser might already be gone. '''
+        if self.closed is False:
+            self.closed = True
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+
+
+class SessionPool:
+    '''
+        A per process pool of browser sessions keyed by platform and capability. Starting a browser takes seconds, so instead of
+        quitting the driver after every test the session is reset (cookies, storage and tabs) and handed to the next test with the
+        same capability. A session is recycled after the max session uses in the driver config or when the test using it failed.
+        Only browsers with the chrome devtools protocol (chrome, chromium, edge) can clear the cookies and storage of every site a
+        test visited, the browsers of other drivers are quit after every test instead.
+    '''
+    _idle_sessions = {}
+    _finalizer = None
+
+
+    @staticmethod
+    def acquire(driver_helper: DriverHelper, capabilities, platform_name, capability) -> BrowserSession:
+        ''' Returns an idle session for the platform and capability passed in, if there is none a new browser is started. '''
+        session_key = f'{platform_name}/{capability}'
+        idle_sessions = SessionPool._idle_sessions.setdefault(session_key, [])
+
+        if driver_helper.reuse_sessions is True and len(idle_sessions) > 0:
+            return idle_sessions.pop()
+
+        # Make sure pooled browsers are closed when the worker process shuts down
+        if SessionPool._finalizer is None:
+            SessionPool._finalizer = util.Finalize(None, SessionPool.close_all, exitpriority=10)
+
+        return BrowserSession(session_key, driver_helper.load_driver(capabilities))
+
+
+    @staticmethod
+    def release(driver_helper: DriverHelper, session: BrowserSession, recycle=False):
+        '''
+            Hands the session back to the pool after a test. Pass in recycle as True if the session must not be used again, for
+            example when the test failed. Sessions which reached the max uses or which could not be reset are quit instead.
+        '''
+        if session.closed is True:
+            return
+
+        session.uses += 1
+        if recycle is True or driver_helper.reuse_sessions is False or session.uses >= driver_helper.max_session_uses \
+           or not hasattr(session.driver, 'execute_cdp_cmd'):
+            session.quit()
+            return
+
+        try:
+            SessionPool._reset_session(driver_helper, session)
+        except Exception:
+            session.quit()
+            return
+
+        SessionPool._idle_sessions.setdefault(session.session_key, []).append(session)
+
+
+    @staticmethod
+    def _reset_session(driver_helper: DriverHelper, session: BrowserSession):
+        '''
+            Clears the cookies of every domain, the storage of every site the tabs visited and closes all but the first tab so the
+            next test gets a clean browser. Uses the chrome devtools protocol, see release.
+        '''
+        driver = session.driver
+        window_handles = driver.window_handles
+        origins = set()
+        for window_handle in reversed(window_handles):
+            driver.switch_to.window(window_handle)
+            for history_entry in driver.execute_cdp_cmd('Page.getNavigationHistory', {})['entries']:
+                origin = SessionPool._get_origin(history_entry['url'])
+                if origin is not None:
+                    origins.add(origin)
+            if window_handle != window_handles[0]:
+                driver.close()
+        driver.switch_to.window(window_handles[0])
+
+        driver.get('about:blank')
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        for origin in origins:
+            driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+
+        if driver_helper.max_window_default is True:
+            driver.maximize_window()
+
+
+    @staticmethod
+    def _get_origin(url):
+        ''' Returns the origin of the url passed in, like https://example.com:8443, or None for pages like about:blank. '''
+        parsed_url = urlparse(url)
+        if parsed_url.scheme not in ('http', 'https') or not parsed_url.hostname:
+            return None
+        port = f':{parsed_url.port}' if parsed_url.port is not None else ''
+        return f'{parsed_url.scheme}://{parsed_url.hostname}{port}'
+
+
+    @staticmethod
+    def close_all():
+        ''' Quits every idle session in the pool. This is called when the worker process shuts down. '''
+        for idle_sessions in SessionPool._idle_sessions.values():
+            for session in idle_sessions:
+                session.quit()
+        SessionPool._idle_sessions = {}
+
+
 class DriverActions:
     ''' This class is the main one used in tests which does the actual interaction with the driver and product under test. '''
     def __init__(self, test_definition: TestDefinition, hook_file_name=False):
         self.driver_setup = DriverHelper()
         self.test_def = test_definition
         self.caps = self.driver_setup.load_capability(test_definition.platform, test_definition.capability)
-        self.driver = self.driver_setup.load_driver(self.caps)
+        self.session = SessionPool.acquire(self.driver_setup, self.caps, test_definition.platform, test_definition.capability)
+        self.driver = self.session.driver
         self.action = ActionChains(self.driver)
         self.wait = WebDriverWait(self.driver, 60)
         if hook_file_name is not False:
@@ -200,8 +331,21 @@ class DriverActions:
 
 
     def quit_the_driver(self):
-        ''' Closes the driver. '''
-        self.driver.quit()
+        ''' Closes the driver. The browser is not handed back to the session pool. '''
+        self.session.quit()
+
+
+    def get_screenshot_png(self):
+        ''' Returns a screenshot of the browser as png bytes, taken by the driver. Returns None if the browser can not take one. '''
+        try:
+            return self.driver.get_screenshot_as_png()
+        except WebDriverException:
+            return None
+
+
+    def release_the_driver(self, recycle=False):
+        ''' Hands the browser back to the session pool for the next test. Pass in recycle as True to close the browser instead. '''
+        SessionPool.release(self.driver_setup, self.session, recycle)
 
 
     def set_browser_window_size(self, window_w, window_h):
@@ -6,12 +6,15 @@ import sys
 import argparse
 from datetime                   import datetime
 from os.path                    import realpath, dirname
-from utilities.json_helper      import LoadJson
 from utilities.file_helper      import FileUtils
 from core.test_profiler         import Profiler
 from core.test_executor         import Executor
-from core.test_reporter         import Reporter
-from core.core_models           import TraverseConfig
+from core.test_reporter         import Reporter, ReporterTasks
+from core.test_distributor      import Coordinator, Agent
+from core.test_daemon           import Daemon
+from core.test_history          import TestHistory
+from core.test_journal          import ResultsJournal
+from core.core_models           import TraverseConfig, ReportDeliveryType
 
 
 # Initiate the parser
@@ -39,6 +42,76 @@ PARSER.add_argument('-T'
                     , type=str
                     , help='Enter the name of the test run you want executed. This is required.')
 
+PARSER.add_argument('--shard'
+                    , type=str
+                    , help='''
+                            Only executes one shard of the test run, enter it as i/n, for example 2/4 for the 2nd of 4 shards. Useful to split a
+                            test run across CI jobs. The results are saved as json so the shards can be joined with --merge. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--changed-only'
+                    , action='store_true'
+                    , help='''
+                            Only executes tests whose suite files, hook files or capability changed since their last run, or which did not pass
+                            last time. The other tests are carried over from their last result in the report. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--tags'
+                    , type=str
+                    , help='''
+                            Only executes the tests of the test run whose tags match the expression you enter, for example "smoke and not slow".
+                            Tags are declared on test methods with @tags or in the suite json, see core/test_selection.py. Replaces the
+                            tagExpression of the test run. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--resume'
+                    , type=str
+                    , help='''
+                            Resumes a test run which crashed or was cancelled. Enter the result directory of that run, the tests in its results
+                            journal are not executed again, only the rest are. The results and report go to the same directory. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--merge'
+                    , nargs='+'
+                    , help='''
+                            Joins the json results of sharded test runs into one report. Enter the result directories (or test_results.json files)
+                            of the shards. Use with -C and -T, the reporter config of the test run is used to report the merged results.
+                        ''')
+
+PARSER.add_argument('--coordinator'
+                    , type=str
+                    , help='''
+                            Runs the test run as a coordinator listening on the address you enter, for example 0.0.0.0:8500. Instead of executing
+                            the tests on this machine, they are handed out to agents which connect to the coordinator. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--agent'
+                    , type=str
+                    , help='''
+                            Runs traverse as an agent which connects to the coordinator on the address you enter, for example 10.0.0.5:8500,
+                            and executes the tests it is given. The agent uses the tests and configs of this copy of traverse.
+                        ''')
+
+PARSER.add_argument('--daemon'
+                    , type=str
+                    , help='''
+                            Runs traverse as a daemon listening on the local address you enter, for example 127.0.0.1:8600. Test runs are
+                            submitted to it with --submit and executed on warm workers which are kept between test runs. Add -C and -T to
+                            warm up the workers of that test run before the first submission.
+                        ''')
+
+PARSER.add_argument('--submit'
+                    , type=str
+                    , help='''
+                            Submits the test run to the daemon on the address you enter, for example 127.0.0.1:8600, and prints the result
+                            of every test as it comes in. Use with -C and -T.
+                        ''')
+
+PARSER.add_argument('--slots'
+                    , type=int
+                    , default=os.cpu_count()
+                    , help='The number of tests an agent executes at the same time. Defaults to the number of CPUs.')
+
 
 # Read arguments from the CMD
 ARGS = PARSER.parse_args()
@@ -122,18 +195,32 @@ if __name__ == '__main__':
         sys.exit()
 
 
+    # Run as an agent for a coordinator, the test run comes from the coordinator
+    if ARGS.agent:
+        Agent(ARGS.agent, ARGS.slots, CURRENT_DIR).run_agent()
+        sys.exit()
+
+
+    # Run as a daemon, test runs are submitted to it
+    if ARGS.daemon:
+        Daemon(ARGS.daemon, CURRENT_DIR).run_daemon((ARGS.config, ARGS.testrun) if ARGS.config and ARGS.testrun else None)
+        sys.exit()
+
+
+    # Submit the test run to a daemon instead of executing it here
+    if ARGS.submit:
+        if not ARGS.config or not ARGS.testrun:
+            raise Exception('Submitting a test run needs the executor config and test run, pass them in with -C and -T')
+
+        summary = Daemon.submit_test_run(ARGS.submit, ARGS.config, ARGS.testrun)
+        print(f"\n{summary['testRunName']}: {summary['passed']} passed, {summary['failed']} failed, {summary['blocked']} blocked "
+              f"of {summary['total']} tests. Results are in {summary['resultDir']}")
+        sys.exit()
+
+
     # Load the Traverse Config
     if ARGS.config and ARGS.testrun:
-        if platform.system() == 'Windows':
-            exec_config_path = f'{CURRENT_DIR}\\config\\executor\\{ARGS.config}.json'
-            test_run_path = f'{CURRENT_DIR}\\test_runs\\{ARGS.testrun}.json'
-        else:
-            exec_config_path = f'{CURRENT_DIR}/config/executor/{ARGS.config}.json'
-            test_run_path = f'{CURRENT_DIR}/test_runs/{ARGS.testrun}.json'
-
-        exec_config = LoadJson.using_filepath(exec_config_path)
-        test_run = LoadJson.using_filepath(test_run_path)
-        trav_con = TraverseConfig(exec_config, test_run, CURRENT_DIR)
+        trav_con = TraverseConfig.load(ARGS.config, ARGS.testrun, CURRENT_DIR)
     else:
         if not ARGS.config:
             raise Exception('No Executor Config specified. Please pass in an executor config to use with the -C argument')
@@ -142,15 +229,66 @@ if __name__ == '__main__':
         else:
             raise Exception('Something else failed, could be an internal bug :(')
 
+    if ARGS.tags:
+        trav_con.tag_expression = ARGS.tags
+
+
+    # A resumed test run keeps using the result directory of the run it continues
+    if ARGS.resume:
+        journal_results = ResultsJournal.load_results(ARGS.resume)
+        trav_con.testrun_result_dir = os.path.join(os.path.abspath(ARGS.resume), '')
+
+
+    # Merge the results of sharded test runs into one report
+    if ARGS.merge:
+        merged_tests = []
+        for results_path in ARGS.merge:
+            merged_tests.extend(ReporterTasks.load_results_json(results_path))
+
+        # Shards do not update the test history so they all split the test run the same way, it is updated once here instead
+        test_history = TestHistory(trav_con)
+        for test_def in merged_tests:
+            test_history.record_result(test_def)
+        test_history.save()
+
+        reporter = Reporter(trav_con, merged_tests)
+        reporter.run_reporter()
+        sys.exit()
+
 
     # Call the Profiler
     profiler = Profiler(trav_con)
-    cartesian = profiler.run_profiler()
+    # Without sharding, changed-only or resume nothing needs the whole cartesian product up front, the executor takes it as it goes
+    cartesian = profiler.run_profiler(lazy=not (ARGS.shard or ARGS.changed_only or ARGS.resume))
+
+    if ARGS.shard:
+        cartesian = profiler.get_test_shard(cartesian, ARGS.shard)
+        print(f'\nExecuting shard {ARGS.shard} with {len(cartesian)} tests.\n')
+
+        # The shard results are always saved as json so they can be merged
+        if ReportDeliveryType.JSON not in trav_con.reporter_settings.report_methods:
+            trav_con.reporter_settings.report_methods.append(ReportDeliveryType.JSON)
+
+    carried_over_tests = []
+    if ARGS.changed_only:
+        cartesian, carried_over_tests = profiler.get_changed_tests(cartesian)
+        print(f'\nExecuting {len(cartesian)} changed tests, {len(carried_over_tests)} tests are carried over from their last run.\n')
+
+    if ARGS.resume:
+        cartesian, resumed_tests = ResultsJournal.get_remaining_tests(cartesian, journal_results)
+        carried_over_tests.extend(resumed_tests)
+        print(f'\nResuming the test run, {len(resumed_tests)} tests already finished, executing the other {len(cartesian)} tests.\n')
+
+    # The Reporter streams the results while the Executor is busy, tests which did not run this time are added up front
+    reporter = Reporter(trav_con, carried_over_tests)
 
     # Call the Executor
-    executor = Executor(trav_con, cartesian)
-    completed_tests = executor.run_executor()
+    executor = Executor(trav_con, cartesian, update_history=ARGS.shard is None, suite_records=profiler.suite_records)
+    executor.add_result_listener(reporter.add_executor_result)
+    if ARGS.coordinator:
+        executor.run_executor(Coordinator(ARGS.coordinator, trav_con, executor.suite_records))
+    else:
+        executor.run_executor()
 
-    # Call the Reporter
-    reporter = Reporter(trav_con, completed_tests)
-    reporter.run_reporter()
+    # Every result is reported already, all that is left is closing the report
+    reporter.close_report()
@@ -4,6 +4,8 @@ import json
 
 class LoadJson:
     ''' All methods that deal with loading a josn file are stored here for easy reuse. '''
+    _cache = {}
+
     @staticmethod
     def using_filepath(json_path):
         ''' Given the file path load the json file into memory and return it. '''
@@ -13,6 +15,18 @@ class LoadJson:
         return json.loads(json_data)
 
 
+    @staticmethod
+    def using_filepath_cached(json_path):
+        '''
+            Same as using_filepath, but the file is only read once per process and the loaded json is kept for the next call.
+            Use this for config files that do not change during a test run. The returned object is shared, do not modify it.
+        '''
+        if json_path not in LoadJson._cache:
+            LoadJson._cache[json_path] = LoadJson.using_filepath(json_path)
+
+        return LoadJson._cache[json_path]
+
+
 class GetJsonValue:
     ''' Helper class which "Gets" a json value by a certain method, thus call this class and then a method of how you wish the get the json value. '''
     @staticmethod
@@ -0,0 +1,79 @@
+''' A helper utility to save screenshots on a background thread, so the test which took them does not wait for them to be written. '''
+import io
+import os
+import queue
+import threading
+
+from PIL import Image
+
+
+class ScreenshotWriter:
+    '''
+        Saves screenshots on a background thread. Pass in the image format (png, jpeg or webp), the quality used for jpeg and webp
+        (1 - 100) and the compression level used for png (0 - 9). If the compression is None, png screenshots are written as they
+        were taken. Call close to wait for the screenshots still queued to be written.
+    '''
+    IMAGE_FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+    def __init__(self, image_format='png', quality=80, compression=None):
+        self.image_format = image_format
+        self.quality = quality
+        self.compression = compression
+        self.screenshots = queue.Queue()
+        self.writer_thread = None
+
+
+    def save(self, png_data: bytes, file_path) -> str:
+        '''
+            Queues the png screenshot passed in to be saved, the file extension of the image format is added to the file path passed
+            in. Returns the path the screenshot will be saved to.
+        '''
+        save_path = f'{file_path}.{self.image_format}'
+
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self._write_screenshots, daemon=True)
+            self.writer_thread.start()
+
+        self.screenshots.put((png_data, save_path))
+        return save_path
+
+
+    def _write_screenshots(self):
+        ''' The loop of the writer thread, it encodes and writes the queued screenshots until it receives None. '''
+        while True:
+            screenshot = self.screenshots.get()
+            if screenshot is None:
+                break
+
+            png_data, save_path = screenshot
+            try:
+                os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                with open(save_path, 'wb') as f_out:
+                    f_out.write(self.encode(png_data))
+            except Exception as err: # A screenshot which can not be saved must not stop the ones after it
+                print(f'Could not save the screenshot {save_path}: {err}')
+
+
+    def encode(self, png_data: bytes) -> bytes:
+        ''' Returns the png screenshot passed in encoded in the image format and compression of this writer. '''
+        if self.image_format == 'png' and self.compression is None:
+            return png_data
+
+        image = Image.open(io.BytesIO(png_data))
+        image_out = io.BytesIO()
+
+        if self.image_format == 'png':
+            image.save(image_out, 'PNG', optimize=False, compress_level=self.compression)
+        else:
+            # Jpeg has no transparency, the screenshot is flattened before it is saved
+            image.convert('RGB').save(image_out, self.IMAGE_FORMATS[self.image_format], quality=self.quality)
+
+        return image_out.getvalue()
+
+
+    def close(self):
+        ''' Waits for the queued screenshots to be written and stops the writer thread. '''
+        if self.writer_thread is not None:
+            self.screenshots.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
@@ -10,6 +10,9 @@ CURRENT_DIR = dirname(realpath(__file__))
 
 class TestData:
     ''' Main test data class that can be imported and used to generate test data easily. '''
+    # The csv files are loaded once per process and shared by every instance, tests create a new TestData for every test.
+    _csv_cache = {}
+
     def __init__(self):
         if platform.system() == 'Windows':
             self.first_name_dir = f'{CURRENT_DIR}\\test_data\\first_names.csv'
@@ -20,14 +23,23 @@ class TestData:
             self.last_name_dir = f'{CURRENT_DIR}/test_data/last_names.csv'
             self.company_name_dir = f'{CURRENT_DIR}/test_data/company_names.csv'
 
-        with codecs.open(self.first_name_dir, encoding='utf-8-sig') as open_file:
-            self.first_names = tuple(reader(open_file))
+        self.first_names = self._load_csv(self.first_name_dir, 'utf-8-sig')
+        self.last_names = self._load_csv(self.last_name_dir)
+        self.company_names = self._load_csv(self.company_name_dir, 'utf-8-sig')
+
 
-        with open(self.last_name_dir, 'r') as open_file:
-            self.last_names = tuple(reader(open_file))
+    @staticmethod
+    def _load_csv(csv_path, encoding=None):
+        ''' Loads the csv file into a tuple of rows. The file is only read the first time, after that the cached rows are returned. '''
+        if csv_path not in TestData._csv_cache:
+            if encoding is None:
+                with open(csv_path, 'r') as open_file:
+                    TestData._csv_cache[csv_path] = tuple(reader(open_file))
+            else:
+                with codecs.open(csv_path, encoding=encoding) as open_file:
+                    TestData._csv_cache[csv_path] = tuple(reader(open_file))
 
-        with codecs.open(self.company_name_dir, encoding='utf-8-sig') as open_file:
-            self.company_names = tuple(reader(open_file))
+        return TestData._csv_cache[csv_path]
 
     def get_random_first_name(self):
         ''' Gets a random first name and returns it as a string type. '''